@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# Offline load benchmark. Starts stub versions of every service the bot talks to, feeds a
+# fake subreddit listing through bot() (or process_submission() one at a time) and
+# reports throughput, time-to-comment percentiles and HTTP calls per post.
+#
+#   python benchmarks/bench_bot.py -p 50 --latency 0.05 --transcode 3
+#   python benchmarks/bench_bot.py -p 50 --compare benchmarks/results/<earlier run>.json
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gfy_mirror"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_services import StubConfig, start_stubs, media_host
+
+__author__ = 'Henri Sweers'
+
+results_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+class FakeSubreddit:
+    def __init__(self, reddit, name):
+        self.reddit = reddit
+        self.display_name = name
+
+    def get_new(self, limit=None):
+        names = [n.lower() for n in self.display_name.split("+")]
+        posts = [p for p in self.reddit.posts if p.subreddit.display_name.lower() in names]
+        return iter(sorted(posts, key=lambda p: p.created_utc, reverse=True)[:limit])
+
+
+class FakeComment:
+    def __init__(self, comment_id):
+        self.id = comment_id
+
+    def edit(self, text):
+        return self
+
+
+class FakeSubmission:
+    def __init__(self, reddit, post_id, subreddit, url, domain):
+        self.reddit = reddit
+        self.id = post_id
+        self.fullname = "t3_" + post_id
+        self.subreddit = FakeSubreddit(reddit, subreddit)
+        self.url = url
+        self.domain = domain
+        self.title = "Benchmark post " + post_id
+        self.created_utc = time.time()
+        self.comments = []
+        self.score = random.randint(1, 500)
+        self.num_comments = random.randint(0, 50)
+
+    def add_comment(self, text):
+        self.reddit.commented[self.id] = time.time()
+        return FakeComment("c" + self.id)
+
+
+class FakeReddit:
+    def __init__(self):
+        self.posts = []
+        self.commented = {}
+
+    def get_subreddit(self, name):
+        return FakeSubreddit(self, name)
+
+    def get_submission(self, submission_id=None, url=None):
+        for p in self.posts:
+            if p.id == submission_id:
+                return p
+
+
+# imgurpython stand-in that goes through the pooled client to the imgur stub
+class FakeImgurClient:
+    class Image:
+        def __init__(self, data):
+            self.__dict__.update(data)
+
+    def get_image(self, image_id):
+        import net
+        return FakeImgurClient.Image(net.get("imgur", "https://api.imgur.com/3/image/" + image_id).json()["data"])
+
+
+# Makes count posts, mostly direct mp4s with some gfycat and streamable ones mixed in
+def make_posts(reddit, count, subs):
+    posts = []
+    for i in range(count):
+        post_id = "b%05d" % i
+        kind = random.random()
+        if kind < 0.15:
+            url, domain = "https://gfycat.com/Bench%d" % i, "gfycat.com"
+        elif kind < 0.25:
+            url, domain = "https://streamable.com/bench%d" % i, "streamable.com"
+        else:
+            url, domain = "http://%s/clips/%s.mp4" % (media_host, post_id), media_host
+        posts.append(FakeSubmission(reddit, post_id, random.choice(subs), url, domain))
+    return posts
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[idx]
+
+
+def run(args):
+    config = StubConfig(latency=args.latency, failure_rate=args.failure_rate,
+                        transcode_seconds=args.transcode, media_size=args.media_size)
+    stubs, overrides = start_stubs(config)
+
+    import net
+    net.host_overrides.update(overrides)
+
+    os.environ.update({"REDDIT_USERNAME": "bench", "REDDIT_PASSWORD": "bench", "STREAMABLE_PASSWORD": "bench",
+                       "IMGUR_CLIENT": "bench", "IMGUR_SECRET": "bench"})
+    import bot
+    from metrics import metrics
+    from mirror_db import open_db
+    from ratelimit import TokenBucket
+
+    # The fake reddit never rate limits, so neither should we unless asked to
+    bot.comment_queue.limiter = TokenBucket(args.comment_rate, max(1, args.comment_rate))
+    bot.comment_queue.edit_limiter = TokenBucket(args.comment_rate, max(1, args.comment_rate))
+    bot.comment_queue.edit_delay = args.edit_delay
+
+    reddit = FakeReddit()
+    bot.r = reddit
+    bot.running_on_heroku = True
+    bot.backends["imgur"].client = FakeImgurClient()
+    bot.backends["streamable"].password = "bench"
+    bot.mirror_db = open_db(os.path.join(tempfile.mkdtemp(), "bench_DB"))
+    for stage, workers in args.workers.items():
+        bot.stage_workers[stage] = workers
+
+    reddit.posts = make_posts(reddit, args.posts, bot.approved_subs)
+    net_before = net.stats.snapshot()
+    start = time.time()
+    if args.mode == "process":
+        for submission in sorted(reddit.posts, key=lambda p: p.created_utc):
+            bot.process_submission(submission)
+    else:
+        bot.bot()
+    bot.comment_queue.join(timeout=args.timeout)
+    elapsed = time.time() - start
+    net_after = net.stats.snapshot()
+
+    latencies = [reddit.commented[p.id] - p.created_utc for p in reddit.posts if p.id in reddit.commented]
+    http_calls = sum(sum(stub.calls.values()) for stub in stubs.values())
+    for stub in stubs.values():
+        stub.stop()
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "mode": args.mode,
+        "settings": {"posts": args.posts, "latency": args.latency, "failure_rate": args.failure_rate,
+                     "transcode": args.transcode, "media_size": args.media_size, "workers": args.workers},
+        "posts": args.posts,
+        "commented": len(latencies),
+        "elapsed": elapsed,
+        "posts_per_minute": 60.0 * len(latencies) / elapsed if elapsed else 0,
+        "time_to_comment": {"p50": percentile(latencies, 50), "p95": percentile(latencies, 95),
+                            "p99": percentile(latencies, 99)},
+        "http_calls_per_post": float(http_calls) / args.posts if args.posts else 0,
+        "http_calls_by_endpoint": dict((stub.name + " " + endpoint, count) for stub in stubs.values()
+                                       for endpoint, count in stub.calls.items()),
+        "connections_opened": net_after["opened"] - net_before["opened"],
+        "connections_reused": net_after["reused"] - net_before["reused"],
+        "metrics": metrics.summary()
+    }
+
+
+def report(result):
+    print("%(commented)d/%(posts)d posts commented in %(elapsed).1fs (%(posts_per_minute).1f/min)" % result)
+    ttc = result["time_to_comment"]
+    if ttc["p50"] is not None:
+        print("time to comment: p50 %.2fs  p95 %.2fs  p99 %.2fs" % (ttc["p50"], ttc["p95"], ttc["p99"]))
+    print("http calls per post: %.1f  (connections %d opened, %d reused)" % (
+        result["http_calls_per_post"], result["connections_opened"], result["connections_reused"]))
+
+
+# Prints how this run moved against an earlier one, flagging anything that got worse
+# by more than threshold (a fraction)
+def compare(result, previous, threshold):
+    checks = [
+        ("posts_per_minute", result["posts_per_minute"], previous["posts_per_minute"], True),
+        ("http_calls_per_post", result["http_calls_per_post"], previous["http_calls_per_post"], False)
+    ]
+    for pct in ("p50", "p95", "p99"):
+        checks.append(("time_to_comment " + pct, result["time_to_comment"][pct],
+                       previous["time_to_comment"][pct], False))
+
+    regressed = False
+    for name, now, before, higher_is_better in checks:
+        if now is None or not before:
+            continue
+        change = (now - before) / before
+        worse = -change if higher_is_better else change
+        flag = "  REGRESSION" if worse > threshold else ""
+        regressed = regressed or bool(flag)
+        print("%-22s %10.2f -> %10.2f  (%+.1f%%)%s" % (name, before, now, change * 100, flag))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline gfy_mirror load benchmark")
+    parser.add_argument("-p", "--posts", type=int, default=30)
+    parser.add_argument("--mode", choices=["bot", "process"], default="bot",
+                        help="drive bot() through the pipeline, or process_submission() one post at a time")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every stub response")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of stub calls that fail")
+    parser.add_argument("--transcode", type=float, default=3.0, help="seconds a stub transcode takes")
+    parser.add_argument("--media-size", type=int, default=512 * 1024)
+    parser.add_argument("--comment-rate", type=float, default=100.0, help="comments per second allowed")
+    parser.add_argument("--edit-delay", type=float, default=1.0, help="seconds progressive edits are held back")
+    parser.add_argument("--worker", action="append", default=[], metavar="STAGE=N",
+                        help="pipeline workers for a stage, e.g. mirror=8")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--name", default="bench")
+    parser.add_argument("--compare", help="earlier result file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+    args.workers = dict((w.split("=")[0], int(w.split("=")[1])) for w in args.worker)
+    random.seed(args.seed)
+
+    result = run(args)
+    report(result)
+
+    if not os.path.exists(results_dir):
+        os.makedirs(results_dir)
+    path = os.path.join(results_dir, "%s-%s.json" % (args.name, time.strftime("%Y%m%d-%H%M%S")))
+    with open(path, "w") as result_file:
+        json.dump(result, result_file, indent=2, sort_keys=True)
+    print("saved " + path)
+
+    if args.compare:
+        with open(args.compare) as previous_file:
+            if compare(result, json.load(previous_file), args.threshold):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse
+
+__author__ = 'Henri Sweers'
+
+# Fake hostnames for media, pointed at the media stub with net.host_overrides
+media_host = "media.stub"
+streamable_cdn_host = "cdn.streamable.stub"
+
+
+# Latency, failure and transcode settings shared by all the stubs
+class StubConfig:
+    def __init__(self, latency=0.05, failure_rate=0.0, transcode_seconds=3.0, media_size=512 * 1024):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.transcode_seconds = transcode_seconds
+        self.media_size = media_size
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+# Base stub. Subclasses implement handle(method, path, query, body) and return (status, data)
+# where data is a dict (sent as json) or bytes.
+class StubService:
+    name = "stub"
+
+    def __init__(self, config):
+        self.config = config
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.server = None
+
+    def start(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                service.dispatch(self, "GET")
+
+            def do_POST(self):
+                service.dispatch(self, "POST")
+
+            def do_HEAD(self):
+                service.dispatch(self, "HEAD")
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:%d" % self.server.server_address[1]
+
+    def dispatch(self, request, method):
+        parsed = urlparse(request.path)
+        length = int(request.headers.get("content-length") or 0)
+        body = request.rfile.read(length) if length else b""
+        endpoint = "%s %s" % (method, "/".join(parsed.path.split("/")[:3]))
+        with self.lock:
+            self.calls[endpoint] += 1
+
+        time.sleep(self.config.latency)
+        if random.random() < self.config.failure_rate:
+            status, data = 500, {"error": "stub failure"}
+        else:
+            status, data = self.handle(method, parsed.path, parsed.query, body)
+
+        payload = data if isinstance(data, bytes) else json.dumps(data).encode("utf-8")
+        request.send_response(status)
+        request.send_header("Content-Type", "video/mp4" if isinstance(data, bytes) else "application/json")
+        request.send_header("Content-Length", str(len(payload)))
+        request.end_headers()
+        if method != "HEAD":
+            request.wfile.write(payload)
+
+    # Starts a fake transcode, returns its id
+    def start_job(self):
+        job_id = "%s%06d" % (self.name, random.randint(0, 999999))
+        with self.lock:
+            self.jobs[job_id] = time.time()
+        return job_id
+
+    def job_done(self, job_id):
+        with self.lock:
+            started = self.jobs.get(job_id)
+        return started is not None and time.time() - started >= self.config.transcode_seconds
+
+    def handle(self, method, path, query, body):
+        return 404, {"error": "not found"}
+
+
+# upload.gfycat.com and www.gfycat.com
+class GfycatStub(StubService):
+    name = "gfycat"
+
+    def handle(self, method, path, query, body):
+        parts = path.strip("/").split("/")
+        if parts[0] == "transcodeRelease":
+            with self.lock:
+                self.jobs[parts[1]] = time.time()
+            return 200, {"isOk": True}
+        if parts[0] == "status":
+            if self.job_done(parts[1]):
+                return 200, {"task": "complete", "gfyname": parts[1]}
+            return 200, {"task": "encoding"}
+        if parts[0] == "cajax":
+            gfy_id = parts[2]
+            return 200, {"gfyItem": {
+                "mp4Url": "http://%s/gfycat/%s.mp4" % (media_host, gfy_id),
+                "webmUrl": "http://%s/gfycat/%s.webm" % (media_host, gfy_id),
+                "gifUrl": "http://%s/gfycat/%s.gif" % (media_host, gfy_id)
+            }}
+        return 404, {"error": "not found"}
+
+
+# offsided.com
+class OffsidedStub(StubService):
+    name = "offsided"
+
+    def handle(self, method, path, query, body):
+        parts = path.strip("/").split("/")
+        if method == "POST" and path == "/api/v1/upload-url":
+            job_id = self.start_job()
+            return 200, {"id": job_id, "canonical_url": "http://offsided.com/link/" + job_id}
+        if parts[:2] == ["api", "v1"] and len(parts) == 3:
+            status = "complete" if self.job_done(parts[2]) else "processing"
+            return 200, {"status": status, "canonical_url": "http://offsided.com/link/" + parts[2]}
+        if parts[0] == "link":
+            return 200, {
+                "mp4_url": "http://%s/offsided/%s.mp4" % (media_host, parts[1]),
+                "webm_url": "http://%s/offsided/%s.webm" % (media_host, parts[1]),
+                "gif_url": None
+            }
+        return 404, {"error": "not found"}
+
+
+# api.streamable.com
+class StreamableStub(StubService):
+    name = "streamable"
+
+    def handle(self, method, path, query, body):
+        parts = path.strip("/").split("/")
+        if parts[0] == "import":
+            return 200, {"shortcode": self.start_job()}
+        if parts[0] == "videos":
+            return 200, {
+                "url_root": "//%s/streamable/%s" % (streamable_cdn_host, parts[1]),
+                "files": {"mp4": {"url": "//%s/streamable/%s.mp4" % (streamable_cdn_host, parts[1])}}
+            }
+        return 404, {"error": "not found"}
+
+
+# api.imgur.com
+class ImgurStub(StubService):
+    name = "imgur"
+
+    def handle(self, method, path, query, body):
+        if method == "POST" and path == "/3/upload":
+            image_id = self.start_job()
+            return 200, {"success": True, "data": {"link": "http://i.imgur.com/%s.gif" % image_id}}
+        parts = path.strip("/").split("/")
+        if parts[:2] == ["3", "image"]:
+            return 200, {"success": True, "data": {
+                "id": parts[2], "link": "http://i.imgur.com/%s.gif" % parts[2],
+                "mp4": "http://i.imgur.com/%s.mp4" % parts[2], "webm": "http://i.imgur.com/%s.webm" % parts[2]
+            }}
+        return 404, {"error": "not found"}
+
+
+# Serves fake media. Each path gets its own deterministic bytes, so different clips
+# fingerprint differently and the same clip fingerprints the same.
+class MediaStub(StubService):
+    name = "media"
+
+    def handle(self, method, path, query, body):
+        rng = random.Random(path)
+        return 200, bytes(rng.getrandbits(8) for _ in range(min(self.config.media_size, 4096))) * \
+            max(1, self.config.media_size // 4096)
+
+
+# Starts one of every stub. Returns (stubs by name, host overrides for net.py)
+def start_stubs(config):
+    stubs = {
+        "gfycat": GfycatStub(config).start(),
+        "offsided": OffsidedStub(config).start(),
+        "streamable": StreamableStub(config).start(),
+        "imgur": ImgurStub(config).start(),
+        "media": MediaStub(config).start()
+    }
+    overrides = {
+        "upload.gfycat.com": stubs["gfycat"].base_url,
+        "www.gfycat.com": stubs["gfycat"].base_url,
+        "gfycat.com": stubs["gfycat"].base_url,
+        "offsided.com": stubs["offsided"].base_url,
+        "api.streamable.com": stubs["streamable"].base_url,
+        "api.imgur.com": stubs["imgur"].base_url,
+        media_host: stubs["media"].base_url,
+        streamable_cdn_host: stubs["media"].base_url
+    }
+    return stubs, overrides
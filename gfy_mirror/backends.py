@@ -0,0 +1,414 @@
+import json
+import os
+import random
+import string
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import quote
+
+import net
+from breaker import breakers, CircuitBreaker
+from cache import MetadataUnavailable
+from metrics import timed, record, track_future
+from poller import scheduler as poll_scheduler, completed_future, unwrap, settle
+from utils import log, Color, get_id, metadata_cache, get_page_meta, retrieve_vine_video_url, retrieve_vine_cdn_url
+
+__author__ = 'Henri Sweers'
+
+
+# Raised instead of queueing an upload when a backend's queue is full
+class BackendBusy(Exception):
+    pass
+
+
+# One host we can resolve media from and/or mirror to. A backend mirrors to the
+# MirroredObject attribute named "<name>_url". Subclasses fill in what their host supports:
+#   resolve_source(url, mirror) - media url to mirror for a post on one of our domains
+#   start_conversion(title, url) - kicks off an upload, returns the mirror url, or a job
+#                                  to hand to poll_status if the host transcodes first
+#   poll_status(job) - (done, mirror url) for a job from start_conversion
+#   expand_urls(mirror_url) - [[type, url], ...] for each format the mirror is available in
+class MirrorBackend:
+    name = None
+    label = None
+    domains = []
+    # Whether start_conversion returns a job to poll rather than the mirror url
+    polls = False
+    # Largest file the host takes, None if there's no limit
+    max_size = None
+    # Content type prefixes the host takes, None for anything
+    media_types = ("image/gif", "video/")
+
+    def __init__(self, max_concurrency=4, queue_size=50, timeout=60):
+        self.max_concurrency = max_concurrency
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.breaker = breakers.get(self.name) or CircuitBreaker(self.name)
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.queued = 0
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def can_mirror(self):
+        return type(self).start_conversion is not MirrorBackend.start_conversion
+
+    # Whether this backend can take the media, given its probe_media() info. An unknown
+    # type is let through, an unknown size only if there's no size limit.
+    def accepts(self, media):
+        size, media_type = media["size"], media["type"]
+        if self.max_size is not None and (size is None or size > self.max_size):
+            return False
+        if self.media_types and media_type and media_type != "application/octet-stream":
+            return media_type.startswith(self.media_types)
+        return True
+
+    def mirror_url(self, mirror):
+        return getattr(mirror, self.name + "_url", "")
+
+    def resolve_source(self, url, mirror):
+        return url
+
+    def start_conversion(self, title, url):
+        return None
+
+    def poll_status(self, job):
+        return True, job
+
+    def expand_urls(self, mirror_url):
+        return []
+
+    # Hosts without an info api, like source-only ones, have nothing to look up
+    def fetch_info(self, media_id):
+        return None
+
+    # Info about a mirror on this host, through the metadata cache
+    def info(self, media_id):
+        return metadata_cache.get(self.name, media_id, lambda: timed("info", self.name)(self.fetch_info)(media_id))
+
+    # Uploads url to this host. Returns a future for the mirror url, which fails with
+    # CircuitOpen if the host is down or BackendBusy if its queue is full. At most
+    # max_concurrency uploads (including their status polling) run at a time, the rest
+    # wait in the backend's queue.
+    def upload(self, title, url):
+        with self.lock:
+            if self.queued >= self.queue_size:
+                f = Future()
+                settle(f, exception=BackendBusy(self.name))
+                return f
+            self.queued += 1
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        task = self.pool.submit(self._upload, title, url)
+        task.add_done_callback(self._cancelled)
+        return unwrap(task)
+
+    # An upload cancelled while it was still queued never gets to take itself off the queue
+    def _cancelled(self, task):
+        if task.cancelled():
+            with self.lock:
+                self.queued -= 1
+
+    # Uploads and waits for the result, e.g. for the retry worker
+    def upload_blocking(self, title, url, timeout=None):
+        return self.upload(title, url).result(timeout=timeout)
+
+    def _upload(self, title, url):
+        self.slots.acquire()
+        with self.lock:
+            self.queued -= 1
+        try:
+            result = self.breaker.call(self._convert, title, url)
+        except Exception:
+            self.slots.release()
+            raise
+        if isinstance(result, Future):
+            result.add_done_callback(lambda f: self.slots.release())
+        else:
+            self.slots.release()
+        return result
+
+    def _convert(self, title, url):
+        start = time.time()
+        try:
+            job = self.start_conversion(title, url)
+        except Exception as e:
+            record("convert", self.name, start, error=e)
+            raise
+        if job and job != "Error" and self.polls:
+            future = poll_scheduler.submit(lambda: self.poll_status(job), timeout=self.timeout,
+                                           name="%s conversion" % self.name)
+        else:
+            future = completed_future(job)
+        track_future("convert", self.name, start, future, empty_is_error=True)
+        return future
+
+
+class GfycatBackend(MirrorBackend):
+    name = "gfycat"
+    label = "Gfycat"
+    domains = ["gfycat.com", "giant.gfycat.com", "zippy.gfycat.com", "fat.gfycat.com"]
+    polls = True
+
+    def resolve_source(self, url, mirror):
+        # giant/zippy/fat links are the media itself, link the gfycat page instead
+        gfy_id = get_id(url)
+        mirror.gfycat_url = "http://gfycat.com/" + gfy_id
+        return self.info(gfy_id)['mp4Url']
+
+    def start_conversion(self, title, url):
+        log('--Converting to gfycat')
+        encoded_url = quote(url, '')
+        key = ''.join(random.SystemRandom().choice(string.ascii_letters + string.digits) for _ in range(8))
+        transcode_url = 'http://upload.gfycat.com/transcodeRelease/' + key + '?noMd5=true&fetchUrl=' + encoded_url
+        conversion_response = net.get("gfycat", transcode_url, idempotent=False)
+        if conversion_response.status_code == 200:
+            j = conversion_response.json()
+            if 'error' in j.keys():
+                log('----Error: ' + j['error'], Color.RED)
+                return None
+        else:
+            print(conversion_response)
+            log('----failed', Color.RED)
+            return "Error"
+        return key
+
+    def poll_status(self, key):
+        j = net.get("gfycat", 'http://upload.gfycat.com/status/' + key).json()
+        if 'error' in j.keys():
+            log('----Error: ' + j['error'], Color.RED)
+            return True, None
+        if 'task' in j.keys() and j['task'] == 'complete':
+            log('----success', Color.GREEN)
+            return True, "http://gfycat.com/" + j["gfyname"]
+        return False, None
+
+    def fetch_info(self, gfy_id):
+        response = net.get("gfycat", "http://www.gfycat.com/cajax/get/%s" % gfy_id)
+        response.raise_for_status()
+        return response.json()['gfyItem']
+
+    def expand_urls(self, mirror_url):
+        info = self.info(get_id(mirror_url))
+        return [["mp4", info['mp4Url']], ["webm", info['webmUrl']], ["gif", info['gifUrl']]]
+
+
+class OffsidedBackend(MirrorBackend):
+    name = "offsided"
+    label = "Offsided"
+    domains = ["offsided.com"]
+    polls = True
+
+    # Falls back to the og:video tag of the page when the link api has no mp4
+    def resolve_source(self, url, mirror):
+        mirror.offsided_url = url
+        try:
+            mp4_url = self.info(get_id(url)).get('mp4_url')
+        except MetadataUnavailable:
+            mp4_url = None
+        return mp4_url or get_page_meta(url, ["og:video"], "offsided").get("og:video")
+
+    def start_conversion(self, title, url):
+        log('--Converting to offsided')
+        req_data = {
+            'url': url,
+            'title': title
+        }
+        r = net.post(
+            "offsided",
+            'http://offsided.com/api/v1/upload-url',
+            data=json.dumps(req_data),
+            headers={
+                'Content-type': 'application/json',
+                'Accept': 'application/json'
+            }
+        )
+        if r.status_code != 200:
+            log('----Error uploading gif: Status code ' + str(r.status_code), Color.RED)
+            return None
+        error_text = r.json().get('error')
+        if error_text:
+            log('----Error uploading gif: ' + error_text, Color.RED)
+            return None
+        return r.json()['id'], r.json()['canonical_url']
+
+    def poll_status(self, job):
+        upload_id, canonical_url = job
+        r = net.get(
+            "offsided",
+            'http://offsided.com/api/v1/' + upload_id,
+            headers={
+                'Accept': 'application/json'
+            }
+        )
+        if r.json()['status'] == 'complete':
+            log('----Video is complete at ' + r.json()['canonical_url'], Color.GREEN)
+            log('----success', Color.GREEN)
+            return True, canonical_url
+        elif r.json()['status'] == 'error':
+            log('----Conversion failed.', Color.RED)
+            return True, None
+        return False, None
+
+    def fetch_info(self, f_id):
+        r = net.get("offsided", "http://offsided.com/link/%s" % f_id)
+        r.raise_for_status()
+        return r.json()
+
+    def expand_urls(self, mirror_url):
+        info = self.info(get_id(mirror_url))
+        return [[x, info[x]] for x in ('mp4_url', 'webm_url', 'gif_url') if info[x]]
+
+
+class StreamableBackend(MirrorBackend):
+    name = "streamable"
+    label = "Streamable"
+    domains = ["streamable.com"]
+    # Set from the login credentials
+    password = None
+
+    def resolve_source(self, url, mirror):
+        mirror.streamable_url = url
+        url_to_process = "%s.mp4" % self.info(get_id(url))["url_root"]
+        if not url_to_process.startswith('https:'):
+            url_to_process = 'https:' + url_to_process
+        return url_to_process
+
+    def start_conversion(self, title, url):
+        log('--Converting to streamable')
+        import_url = "https://api.streamable.com/import?url=%s&noresize" % url
+        r = net.get("streamable", import_url, idempotent=False, auth=('gfy_mirror', self.password))
+        try:
+            upload_id = r.json()["shortcode"]
+        except (ValueError, KeyError):
+            log('----Error: unexpected response, status code ' + str(r.status_code), Color.RED)
+            return None
+        return "https://streamable.com/%s" % upload_id
+
+    def fetch_info(self, s_id):
+        r = net.get("streamable", "https://api.streamable.com/videos/%s" % s_id, auth=('gfy_mirror', 'WinYeaUsEyZ7W4'))
+        r.raise_for_status()
+        return r.json()
+
+    def expand_urls(self, mirror_url):
+        info = self.info(get_id(mirror_url))
+        return [[x, "https:" + info["files"][x]["url"]] for x in info["files"]]
+
+
+class ImgurBackend(MirrorBackend):
+    name = "imgur"
+    label = "Imgur"
+    domains = ["imgur.com", "i.imgur.com"]
+    # Imgur's limit for non-animated uploads by url
+    max_size = 10 * 1024 * 1024
+    media_types = ("image/", "video/")
+    # ImgurClient, or a function that makes one the first time it's needed
+    client = None
+    make_client = None
+
+    def resolve_source(self, url, mirror):
+        mirror.imgur_url = url
+        info = self.info(get_id(url))
+        if "mp4" in info:
+            return info["mp4"]
+        if os.path.splitext(info["link"])[1] == ".gif":
+            return info["link"]
+        return None
+
+    def start_conversion(self, title, url):
+        log('--Uploading to imgur')
+        headers = {"Authorization": "Client-ID c4f5de959205bb4",
+                   'Content-type': 'application/json',
+                   'Accept': 'application/json'}
+        req_data = {
+            'image': url,
+            'title': title,
+            'type': 'URL'
+        }
+        r = net.post(
+            "imgur",
+            'https://api.imgur.com/3/upload',
+            data=json.dumps(req_data),
+            headers=headers
+        )
+        if r.status_code != 200:
+            log('----Error uploading to imgur: Status code ' + str(r.status_code), Color.RED)
+            return None
+        jdata = r.json()
+        if not jdata['success']:
+            log('----Error uploading to imgur', Color.RED)
+            return None
+        return jdata['data']['link']
+
+    def fetch_info(self, i_id):
+        if self.client is None and self.make_client:
+            self.client = self.make_client()
+        return dict(self.client.get_image(i_id).__dict__)
+
+    def expand_urls(self, mirror_url):
+        info = self.info(get_id(mirror_url))
+        imgur_info = []
+        if info.get("mp4"):
+            imgur_info.append(["mp4", info["mp4"]])
+        if info.get("webm"):
+            imgur_info.append(["webm", info["webm"]])
+        if os.path.splitext(info["link"])[1] == ".gif":
+            imgur_info.append(["gif", info["link"]])
+        return imgur_info
+
+
+# Source only, nothing gets mirrored to vine
+class VineBackend(MirrorBackend):
+    name = "vine"
+    label = "Vine"
+    domains = ["vine.co", "v.cdn.vine.co"]
+
+    def resolve_source(self, url, mirror):
+        if "v.cdn.vine.co" in url:
+            return retrieve_vine_cdn_url(url)
+        return self.breaker.call(retrieve_vine_video_url, url)
+
+
+# All the backends, in the order their mirrors are listed in comments
+class BackendRegistry:
+    def __init__(self, backends):
+        self.backends = list(backends)
+
+    def __iter__(self):
+        return iter(self.backends)
+
+    def __getitem__(self, name):
+        for backend in self.backends:
+            if backend.name == name:
+                return backend
+        raise KeyError(name)
+
+    # The backend for posts on this domain, or None
+    def for_domain(self, domain):
+        for backend in self.backends:
+            if domain in backend.domains:
+                return backend
+        return None
+
+    # Backends we can upload to
+    def mirrors(self):
+        return [b for b in self.backends if b.can_mirror()]
+
+
+# Concurrent uploads, queued uploads and status polling timeout (seconds) per backend. Gfycat
+# and offsided hold a slot for the whole transcode, so they get more of them.
+backend_settings = {
+    "gfycat": {"max_concurrency": 6, "queue_size": 50, "timeout": 60},
+    "offsided": {"max_concurrency": 6, "queue_size": 50, "timeout": 60},
+    "imgur": {"max_concurrency": 2, "queue_size": 20, "timeout": 30},
+    "streamable": {"max_concurrency": 4, "queue_size": 50, "timeout": 30},
+    "vine": {"max_concurrency": 2, "queue_size": 10, "timeout": 15}
+}
+
+registry = BackendRegistry([
+    GfycatBackend(**backend_settings["gfycat"]),
+    OffsidedBackend(**backend_settings["offsided"]),
+    ImgurBackend(**backend_settings["imgur"]),
+    StreamableBackend(**backend_settings["streamable"]),
+    VineBackend(**backend_settings["vine"])
+])
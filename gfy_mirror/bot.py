@@ -1,25 +1,114 @@
 #!/usr/bin/env python
+import time
+
+# For the startup report, taken before the imports below
+process_start = time.time()
+
 import atexit
+import concurrent.futures
 import getopt
 import json
 import logging
+import math
 import os
+import re
 import sys
-import time
 import datetime
-import praw
-import praw.helpers
 import signal
-from imgurpython import ImgurClient
-from utils import log, Color, retrieve_vine_video_url, gfycat_convert, get_id, get_gfycat_info, \
-    offsided_convert, imgur_upload, get_offsided_info, notify_mac, retrieve_vine_cdn_url, get_streamable_info, \
-    streamable_convert, get_remote_file_size
+import threading
+from utils import log, Color, notify_mac, metadata_cache
+from probe import probe_media
+from poller import PollTimeout
+import net
+from mirror_db import open_db
+from fingerprint import fingerprint_media
+from sub_scheduler import SubredditScheduler
+from comment_queue import CommentQueue
+from ratelimit import limiters
+from pipeline import Pipeline, Stage
+from metrics import metrics, timed, start_http_server
+from poller import scheduler as poll_scheduler
+from retry_queue import RetryWorker
+from leases import LeaseManager
+from breaker import breakers, CircuitOpen
+from backends import registry as backends, BackendBusy
 
 __author__ = 'Henri Sweers'
 
 # DB for caching previous posts
 cache_file = "gfy_mirror_DB"
 
+# Opened MirrorDB, set up in main
+mirror_db = None
+
+# Metadata cache saved between runs
+metadata_cache_file = "gfy_mirror_metadata.json"
+
+# Adaptive per-subreddit polling, set up in main
+sub_scheduler = None
+
+# Workers per pipeline stage, and how many items each stage can have queued
+stage_workers = {
+    "discover": 1,
+    "resolve": 4,
+    "mirror": 4,
+    "comment": 1
+}
+stage_queue_size = 100
+
+# Under a backlog the discover, resolve and mirror stages take the posts that will reach
+# the most readers first. A post's head start in the queues, in seconds, grows with the
+# log of its votes and comments per minute and its subreddit's weight, up to this much.
+max_priority_boost = 5 * 60
+
+# Seconds of head start for each doubling of a post's velocity
+priority_boost_per_doubling = 30
+
+# The discover -> resolve -> mirror -> comment pipeline, created on first use
+pipeline = None
+
+# Prometheus-style metrics, written to this file after every pass if set, and served over
+# http on METRICS_PORT if that's set
+metrics_file = os.environ.get('METRICS_FILE')
+
+# Post the comment as soon as the first mirror is ready and edit the rest in as they finish
+progressive_comments = True
+
+# Retries failed uploads in the background, set up in main
+retry_worker = None
+
+# Uploads still going after their post's deadline, {(post id, service): MirrorJob}
+late_uploads = {}
+late_uploads_lock = threading.Lock()
+
+# Leases on subreddits and posts in the mirror DB, so workers sharing it split them up.
+# Set up in main.
+leases = None
+
+# Seconds between looks for posts a dead worker claimed and never finished
+lease_sweep_interval = 5 * 60
+
+# Where backfill runs record the posts they've finished, one id per line, so an interrupted
+# run picks up where it stopped. BACKFILL_CHECKPOINT_PATH overrides it.
+backfill_checkpoint_file = "gfy_mirror_backfill_done"
+
+# Posts a backfill run works on at once, and how many it looks up on reddit per request
+backfill_workers = 4
+backfill_batch_size = 100
+
+# Max seconds to wait for queued comments to post before a run exits
+comment_flush_timeout = 10 * 60
+
+# Keep running and polling subreddits as they come due, even on Heroku
+daemon_mode = False
+
+# Set on SIGTERM/SIGINT: stop discovering new posts and wind down
+shutdown_requested = threading.Event()
+
+# Seconds to wind down in after a shutdown signal (Heroku kills us 30 seconds after
+# SIGTERM). Two thirds go to letting in-flight posts finish, the rest to posting comments.
+shutdown_timeout = 25
+
 # File with login credentials
 propsFile = "credentials.json"
 
@@ -32,9 +121,28 @@ dry_run = False
 # Notify on mac
 notify = False
 
+# Also walk the comment tree when the local index says we haven't commented. Slow, only
+# needed if the index might be missing comments (e.g. a fresh DB without a rebuild)
+verify_comment_tree = False
+
 # Bot name
 bot_name = "gfy_mirror"
 
+# Login credentials, read once by retrieve_login_credentials
+login_info = None
+
+# How long a saved reddit login session is reused before logging in again
+session_max_age = 12 * 60 * 60
+
+# (phase, seconds) for the startup report
+startup_phases = []
+
+# Max seconds to wait on the mirror uploads for a single post
+mirror_timeout = 90
+
+# Max seconds for a post from the start of resolving to having all its mirrors
+submission_deadline = 120
+
 allowedDomains = [
     "gfycat.com",
     "vine.co",
@@ -54,6 +162,12 @@ disabled_extensions = [".jpg", ".jpeg", ".png"]
 
 approved_subs = ['soccer', 'reddevils', 'LiverpoolFC', 'swanseacity', 'OmarTilDeath']
 
+# How much a post's priority counts for per subreddit, roughly by how many readers a mirror
+# there reaches. Subreddits not listed count 1.
+sub_weights = {
+    'soccer': 2.0
+}
+
 # Comment strings
 comment_intro = """
 Mirrored links
@@ -71,95 +185,160 @@ vine_warning = """*NOTE: The original url was a Vine, which has audio.
 Gfycat removes audio, but the others should be fine*\n\n"""
 
 
+# Version of the stored MirroredObject format. v1 was the object's __dict__ as a JSON
+# object, v2 is a JSON array: [2, op_id, original_url, [[service, url, variants], ...]]
+# where variants are the [[type, url], ...] pairs the mirror is available in.
+mirror_format_version = 2
+
+
+# One post and its mirrors. Each mirror's variant urls (mp4/webm/gif...) are looked up
+# once when the mirror is stored, so rendering or re-rendering the comment doesn't need
+# the network.
 class MirroredObject:
-    op_id = ""
-    original_url = ""
-    gfycat_url = ""
-    offsided_url = ""
-    imgur_url = ""
-    streamable_url = ""
-
-    def __init__(self, op_id, original_url, json_data=None):
-        if json_data:
-            self.__dict__ = json.loads(json_data)
-        else:
-            self.op_id = op_id
-            self.original_url = original_url
+    mirror_fields = tuple(backend.name + "_url" for backend in backends.mirrors())
+    __slots__ = ("op_id", "original_url", "variants") + mirror_fields
+
+    def __init__(self, op_id, original_url):
+        self.op_id = op_id
+        self.original_url = original_url
+        self.variants = {}
+        for field in self.mirror_fields:
+            setattr(self, field, "")
+
+    # Sets the mirror url for a service and captures its variant urls
+    def set_mirror(self, service, url):
+        setattr(self, service + "_url", url)
+        self.variants.pop(service, None)
+        self.fill_variants()
+
+    # Looks up the variant urls of every mirror that doesn't have them yet. An empty list
+    # isn't kept, the host may just not have finished making them (e.g. right after a
+    # Streamable import), so the next render asks again.
+    def fill_variants(self):
+        for backend in backends.mirrors():
+            mirror_url = backend.mirror_url(self)
+            if mirror_url and backend.name not in self.variants:
+                try:
+                    variants = backend.expand_urls(mirror_url)
+                    if variants:
+                        self.variants[backend.name] = variants
+                except Exception:
+                    log("--Couldn't get %s variants for %s" % (backend.label, mirror_url), Color.RED)
 
     def comment_string(self, domain):
+        # Only records from before variants were stored (or whose lookup failed or came back
+        # empty) need this
+        self.fill_variants()
         s = "\n"
         if self.original_url:
             if "vine.co" in self.original_url:
                 s += vine_warning
             s += "* [Original (%s)](%s)" % (domain, self.original_url)
-        if self.gfycat_url:
-            gfy_id = get_id(self.gfycat_url)
-            urls = self.gfycat_urls(gfy_id)
-            s += "\n\n"
-            s += "* [Gfycat](%s) | [mp4](%s) - [webm](%s) - [gif](%s)" % (
-                self.gfycat_url, urls[0], urls[1], urls[2])
-        if self.offsided_url:
-            s += "\n\n"
-            s += "* [Offsided](%s) | " % self.offsided_url
-            for mediaType, url in self.offsided_urls(get_id(self.offsided_url)):
-                s += "[%s](%s) - " % (mediaType, url)
-            s = s[0:-2]  # Shave off the last "- "
-        if self.imgur_url:
-            s += "\n\n"
-            s += "* [Imgur](%s) | " % self.imgur_url
-            for mediaType, url in self.imgur_urls(get_id(self.imgur_url)):
-                s += "[%s](%s) - " % (mediaType, url)
-            s = s[0:-2]  # Shave off the last "- "
-        if self.streamable_url:
-            s += "\n\n"
-            s += "* [Streamable](%s) | " % self.streamable_url
-            for mediaType, url in self.streamable_urls(get_id(self.streamable_url)):
-                s += "[%s](%s) - " % (mediaType, url)
-            s = s[0:-2]  # Shave off the last "- "
+        for backend in backends.mirrors():
+            mirror_url = backend.mirror_url(self)
+            if mirror_url:
+                s += "\n\n"
+                s += "* [%s](%s) | " % (backend.label, mirror_url)
+                for mediaType, url in self.variants.get(backend.name, []):
+                    s += "[%s](%s) - " % (mediaType, url)
+                s = s[0:-2]  # Shave off the last "- "
         s += "\n"
         return s
 
     def to_json(self):
-        return json.dumps(self.__dict__)
-
-    @staticmethod
-    def gfycat_urls(gfy_id):
-        info = get_gfycat_info(gfy_id)
-        return info['mp4Url'], info['webmUrl'], info['gifUrl']
-
-    @staticmethod
-    def offsided_urls(fit_id):
-        info = get_offsided_info(fit_id)
-        return [[x, info[x]] for x in ('mp4_url', 'webm_url', 'gif_url') if info[x]]
-
-    @staticmethod
-    def streamable_urls(s_id):
-        info = get_streamable_info(s_id)
-        return [[x, "https:" + info["files"][x]["url"]] for x in info["files"]]
-
-    @staticmethod
-    def imgur_urls(s_id):
-        info = imgur_client.get_image(s_id)
-        imgur_info = []
-        if info.__dict__["mp4"]:
-            imgur_info.append(["mp4", info.mp4])
-        if info.__dict__["webm"]:
-            imgur_info.append(["webm", info.webm])
-        if extension(info.link) == "gif":
-            imgur_info.append(["gif", info.link])
-        return imgur_info
+        return json.dumps(self.to_record(), separators=(',', ':'))
+
+    def to_record(self):
+        mirrors = []
+        for field in self.mirror_fields:
+            url = getattr(self, field)
+            if url:
+                service = field[:-4]
+                mirrors.append([service, url, self.variants.get(service)])
+        return [mirror_format_version, self.op_id, self.original_url, mirrors]
+
+    @classmethod
+    def from_json(cls, json_data):
+        return cls.from_record(json.loads(json_data))
+
+    @classmethod
+    def from_record(cls, record):
+        if isinstance(record, dict):
+            # v1
+            mirror = cls(record.get("op_id", ""), record.get("original_url", ""))
+            for field in cls.mirror_fields:
+                setattr(mirror, field, record.get(field) or "")
+            return mirror
+        version, op_id, original_url, mirrors = record[:4]
+        if version > mirror_format_version:
+            raise ValueError("Unknown mirror format version %s" % version)
+        mirror = cls(op_id, original_url)
+        for service, url, variants in mirrors:
+            if service + "_url" in cls.mirror_fields:
+                setattr(mirror, service + "_url", url)
+                if variants:
+                    mirror.variants[service] = variants
+        return mirror
+
+    # Returns a copy of this mirror for another post of the same media
+    def copy_for(self, op_id, original_url):
+        copy = MirroredObject(op_id, original_url)
+        for field in self.mirror_fields:
+            setattr(copy, field, getattr(self, field))
+        copy.variants = dict(self.variants)
+        return copy
 
 
 # Called when exiting the program
 def exit_handler():
     log("SHUTTING DOWN", Color.BOLD)
+    log("HTTP connections - %(opened)d opened, %(reused)d reused" % net.stats.snapshot(), Color.BOLD)
+    log("Metadata cache - %(hits)d hits, %(misses)d misses, %(negative_hits)d negative hits"
+        % metadata_cache.stats(), Color.BOLD)
+    try:
+        metadata_cache.save(metadata_cache_file)
+    except OSError:
+        log("Couldn't save metadata cache", Color.RED)
+    for line in metrics.summary():
+        log("--" + line, Color.BOLD)
+    write_metrics()
+    if leases:
+        # Whatever we didn't get to is up for grabs right away instead of after the ttl
+        leases.release_all()
+
+
+# Writes the metrics file, if there is one
+def write_metrics():
+    if metrics_file:
+        try:
+            metrics.write_file(metrics_file)
+        except OSError:
+            log("Couldn't write metrics to " + metrics_file, Color.RED)
+
 
+# Gauges for everything that has a queue
+def register_gauges():
+    metrics.gauge_fn("comment_queue_depth", comment_queue.pending)
+    metrics.gauge_fn("poll_jobs", poll_scheduler.in_flight)
+    for name, breaker in breakers.items():
+        metrics.gauge_fn("circuit_open", lambda b=breaker: int(b.state != "closed"), {"service": name})
+    for backend in backends.mirrors():
+        metrics.gauge_fn("backend_queue_depth", lambda b=backend: b.queued, {"service": backend.name})
+    for stage in get_pipeline().stages:
+        metrics.gauge_fn("stage_queue_depth", stage.queue.qsize, {"stage": stage.name})
+        metrics.gauge_fn("stage_busy_workers", lambda s=stage: s.busy, {"stage": stage.name})
 
-# Called on SIGINT
+
+# Called on SIGINT and SIGTERM. The first asks the run to wind down, a second one exits.
 # noinspection PyUnusedLocal
 def signal_handler(input_signal, frame):
-    log('\nCaught SIGINT, exiting gracefully', Color.RED)
-    sys.exit()
+    if dry_run or shutdown_requested.is_set():
+        log('\nCaught signal %d, exiting now' % input_signal, Color.RED)
+        sys.exit()
+    log('\nCaught signal %d, finishing in-flight posts' % input_signal, Color.RED)
+    shutdown_requested.set()
+    if retry_worker:
+        retry_worker.stop()
 
 
 # Function to exit the bot
@@ -167,8 +346,11 @@ def exit_bot():
     sys.exit()
 
 
-# Login
+# Login credentials, read from the environment or the credentials file the first time
 def retrieve_login_credentials():
+    global login_info
+    if login_info is not None:
+        return login_info
     if running_on_heroku:
         login_info = [os.environ['REDDIT_USERNAME'],
                       os.environ['REDDIT_PASSWORD'],
@@ -190,13 +372,105 @@ def retrieve_login_credentials():
         return login_info
 
 
+# Logs in to reddit, reusing the session saved in the mirror DB by an earlier run if it's
+# recent enough and reddit still takes it. Returns the praw.Reddit.
+def reddit_login():
+    import praw
+    # The update check is another request to pypi on every start
+    reddit = praw.Reddit(user_agent='/u/gfy_mirror by /u/pandanomic', disable_update_check=True)
+    credentials = retrieve_login_credentials()
+
+    saved = mirror_db.get_state("reddit_session") if mirror_db else None
+    if saved:
+        session = json.loads(saved)
+        if session["user"] == credentials[0] and time.time() - session["saved"] < session_max_age:
+            reddit.http.cookies.update(session["cookies"])
+            reddit.modhash = session["modhash"]
+            # What login() sets up once it has the cookie
+            reddit._authentication = True
+            reddit.user = reddit.get_redditor(session["user"])
+            reddit.user.__class__ = praw.objects.LoggedInRedditor
+            if session_is_valid(reddit, credentials[0]):
+                log("--Reusing login session", Color.GREEN)
+                return reddit
+            log("--Saved login session was rejected", Color.YELLOW)
+
+    return password_login(reddit)
+
+
+# Whether reddit still knows us by the session cookie. One small request, and it also
+# refreshes the modhash.
+def session_is_valid(reddit, username):
+    try:
+        me = reddit.request_json(reddit.config.api_url + "/api/me.json", as_objects=False)
+    except Exception:
+        logging.exception("Error checking login session")
+        return False
+    return me.get("data", {}).get("name", "").lower() == username.lower()
+
+
+# Logs reddit in with the password and saves the session for later runs
+def password_login(reddit):
+    credentials = retrieve_login_credentials()
+    reddit.login(credentials[0], credentials[1], disable_warning=True)
+    log("--Login successful", Color.GREEN)
+    if mirror_db:
+        mirror_db.set_state("reddit_session", json.dumps({
+            "user": credentials[0],
+            "cookies": dict(reddit.http.cookies),
+            "modhash": reddit.modhash,
+            "saved": time.time()
+        }))
+    return reddit
+
+
+# Hands the backends their credentials. The imgur client is only made when first needed.
+def configure_backends():
+    credentials = retrieve_login_credentials()
+    backends["streamable"].password = credentials[2]
+
+    def make_imgur_client():
+        from imgurpython import ImgurClient
+        return ImgurClient(credentials[3], credentials[4])
+    backends["imgur"].make_client = make_imgur_client
+
+
+# Records how long a startup phase took, since the previous one
+def startup_mark(phase):
+    elapsed = time.time() - process_start - sum(seconds for _, seconds in startup_phases)
+    startup_phases.append((phase, elapsed))
+    metrics.observe("startup_seconds", elapsed, {"phase": phase})
+
+
+def log_startup():
+    log("Startup took %.2fs - %s" % (sum(seconds for _, seconds in startup_phases),
+                                    ", ".join("%s %.2fs" % phase for phase in startup_phases)), Color.BOLD)
+
+
 # Retrieves the extension
 def extension(url_to_split):
     return os.path.splitext(url_to_split)[1]
 
 
-# Checks if we've already commented there
+# Checks if we've already commented there, using the local index of commented submissions
+@timed("previously_commented")
 def previously_commented(submission):
+    if comment_queue.has_pending(submission.id):
+        log("----Comment already queued, skipping")
+        return True
+    if mirror_db:
+        if mirror_db.has_commented(submission.id):
+            log("----Previously commented, skipping")
+            return True
+        if not verify_comment_tree:
+            return False
+
+    return comment_tree_has_reply(submission)
+
+
+# Walks the whole comment tree looking for one of ours
+def comment_tree_has_reply(submission):
+    import praw.helpers
     flat_comments = praw.helpers.flatten_tree(submission.comments)
     for comment in flat_comments:
         try:
@@ -222,84 +496,334 @@ def submission_is_valid(submission):
     return False, False
 
 
-# Process a gif post
-def process_submission(submission):
-    new_mirror = MirroredObject(submission.id, submission.url)
+# Looks for an existing mirror of this post's url, returns a MirroredObject for it or None
+def find_existing_mirror(submission):
+    if not mirror_db:
+        return None
+    json_data = mirror_db.find_by_op_id(submission.id) or mirror_db.find_by_url(submission.url)
+    if not json_data:
+        return None
+    return MirroredObject.from_json(json_data).copy_for(submission.id, submission.url)
+
+
+# Fingerprints the media to process, returns None if it couldn't be
+def fingerprint_submission(url_to_process):
+    if not mirror_db:
+        return None
+    try:
+        return fingerprint_media(url_to_process)
+    except Exception:
+        log("--Couldn't fingerprint " + url_to_process, Color.RED)
+        return None
+
+
+# A submission on its way through the pipeline
+class MirrorJob:
+    def __init__(self, submission):
+        self.submission = submission
+        self.mirror = MirroredObject(submission.id, submission.url)
+        self.url_to_process = submission.url
+        self.fingerprint = None
+        # Set when the mirrors came from the DB and there's nothing to convert
+        self.reused = False
+        # Services the mirror stage is uploading to
+        self.targets = []
+        # Set when a shutdown handed the job to the retry queue
+        self.checkpointed = False
+        self.deadline = time.time() + submission_deadline
+
+    # Seconds left before the deadline
+    def remaining(self):
+        return max(0, self.deadline - time.time())
+
+
+# Uses mirrors we already have instead of converting again
+def reuse_mirror(job, existing_mirror):
+    job.mirror = existing_mirror
+    job.reused = True
+    mirror_db.save(existing_mirror)
+    if job.fingerprint:
+        mirror_db.save_fingerprint(job.submission.id, job.fingerprint)
+    return job
+
+
+# Discovery stage: drops posts we can't or shouldn't mirror
+def discover_stage(submission):
+    is_valid, has_commented = submission_is_valid(submission)
+    log("Analyzing " + submission.title)
+    if not is_valid:
+        return None
+    if leases:
+        if not leases.acquire("post:" + submission.id):
+            log("--Another worker has " + submission.id, Color.BLUE)
+            return None
+        # Another worker may have finished it between the check above and taking the lease
+        if mirror_db and mirror_db.has_commented(submission.id):
+            log("----Previously commented, skipping")
+            leases.release("post:" + submission.id)
+            return None
+    log("New Post in /r/" + submission.subreddit.display_name + " - " + submission.url, Color.GREEN)
+    return submission
+
+
+# Puts posts whose lease expired without a comment (the worker that claimed them died)
+# back into the pipeline. Discovery only lists a post once, so nothing else would. Returns
+# how many.
+def sweep_abandoned_posts():
+    if not leases:
+        return 0
+    claimed = [s_id for s_id in mirror_db.abandoned_post_ids(time.time()) if leases.acquire("post:" + s_id)]
+    if not claimed:
+        return 0
+    log("Picking up %d posts another worker abandoned" % len(claimed), Color.YELLOW)
+    found = []
+    for i in range(0, len(claimed), 100):
+        # None when none of them exist any more
+        for submission in r.get_info(thing_id=["t3_" + s_id for s_id in claimed[i:i + 100]]) or []:
+            found.append(submission.id)
+            get_pipeline().put(submission)
+    for s_id in set(claimed) - set(found):
+        log("--%s is gone" % s_id, Color.YELLOW)
+        leases.release("post:" + s_id)
+    return len(found)
+
+
+# Lets another worker pick up a post we dropped after claiming it
+# noinspection PyUnusedLocal
+def release_dropped(stage_name, item):
+    submission = getattr(item, "submission", item)
+    if leases and leases.holds("post:" + submission.id):
+        leases.release("post:" + submission.id)
 
-    already_gfycat = False
+
+# Resolve stage: finds the actual media url to mirror, or existing mirrors of it
+def resolve_submission(submission):
+    job = MirrorJob(submission)
+    new_mirror = job.mirror
+
+    existing_mirror = find_existing_mirror(submission)
+    if existing_mirror:
+        log("--Found existing mirror in DB, skipping conversion", Color.GREEN)
+        return reuse_mirror(job, existing_mirror)
 
     url_to_process = submission.url
+    source = backends.for_domain(submission.domain)
+    if source:
+        url_to_process = source.resolve_source(url_to_process, new_mirror)
+        if not url_to_process:
+            return None
+        new_mirror.fill_variants()
+
+    job.url_to_process = url_to_process
+
+    # Same media reposted from another host
+    job.fingerprint = fingerprint_submission(url_to_process)
+    if job.fingerprint:
+        json_data = mirror_db.find_by_fingerprint(job.fingerprint)
+        if json_data:
+            log("--Found mirror of the same media in DB, skipping conversion", Color.GREEN)
+            existing_mirror = MirroredObject.from_json(json_data).copy_for(submission.id, submission.url)
+            return reuse_mirror(job, existing_mirror)
+
+    return job
 
-    if submission.domain == "vine.co":
-        url_to_process = retrieve_vine_video_url(url_to_process)
-    elif submission.domain == "v.cdn.vine.co":
-        url_to_process = retrieve_vine_cdn_url(url_to_process)
-    elif submission.domain == "gfycat.com":
-        already_gfycat = True
-        new_mirror.gfycat_url = url_to_process
-        url_to_process = get_gfycat_info(get_id(url_to_process))['mp4Url']
-    elif submission.domain == "offsided.com":
-        new_mirror.offsided_url = url_to_process
-        url_to_process = get_offsided_info(get_id(url_to_process))['mp4_url']
-    elif submission.domain == "streamable.com":
-        new_mirror.streamable_url = url_to_process
-        url_to_process = "%s.mp4" % get_streamable_info(get_id(url_to_process))["url_root"]
-        if not url_to_process.startswith('https:'):
-            url_to_process = 'https:' + url_to_process
-    elif submission.domain == "imgur.com" or submission.domain == "i.imgur.com":
-        new_mirror.imgur_url = url_to_process
-        imgur_data = imgur_client.get_image(get_id(url_to_process))
-        if extension(url_to_process) == "gif":
-            url_to_process = imgur_data.link
-        elif "mp4" in imgur_data.__dict__:
-            url_to_process = imgur_data.__dict__["mp4"]
-        else:
-            return
 
-    if submission.domain == "giant.gfycat.com":
-        # Just get the gfycat url
-        url_to_process = url_to_process.replace("giant.", "")
-        new_mirror.gfycat_url = url_to_process
-        already_gfycat = True
+# Mirror stage: uploads to every service we don't already have a mirror on
+def mirror_submission(job):
+    if job.reused:
+        return job
+
+    submission = job.submission
+    url_to_process = job.url_to_process
 
     # Get converting
     log("--Beginning conversion, url to convert is " + url_to_process)
-    if not already_gfycat:
-        gfy_url = gfycat_convert(url_to_process)
-        if gfy_url:
-            new_mirror.gfycat_url = gfy_url
-            log("--Gfy url is " + new_mirror.gfycat_url)
-
-    remote_size = get_remote_file_size(url_to_process)
-
-    if submission.domain != "offsided.com":
-        fitba_url = offsided_convert(submission.title, url_to_process)
-        if fitba_url:
-            new_mirror.offsided_url = fitba_url
-            log("--Offsided url is " + new_mirror.offsided_url)
-
-    if submission.domain != "streamable.com":
-        new_mirror.streamable_url = streamable_convert(url_to_process, retrieve_login_credentials()[2])
-        log("--Streamable url is " + new_mirror.streamable_url)
-
-    # if (submission.domain != "imgur.com" and submission.domain != "i.imgur.com") and remote_size < 10485760:
-    #     # 10MB file size limit
-    #     imgurdata = imgur_client.upload_from_url(url_to_process, config=None, anon=True)
-    #     print("Imgurdata - " + imgurdata)
-    #     new_mirror.imgur_url = imgurdata.link
-    #     log("--Imgur url is " + new_mirror.imgur_url)
-
-    comment_string = comment_intro + new_mirror.comment_string(submission.domain) + comment_info
-
-    add_comment(submission, comment_string)
-    if not already_gfycat:
-        # Take some time to avoid rate limiting. Annoying but necessary
-        log('-Waiting 60 seconds', Color.CYAN)
-        time.sleep(60)
-
-
-# Add the comment with info
-def add_comment(submission, comment_string):
+    targets = [b for b in backends.mirrors() if not b.mirror_url(job.mirror)]
+    media = probe_media(url_to_process)
+    for backend in [b for b in targets if not b.accepts(media)]:
+        log("--Skipping %s for %s (%s bytes)" % (backend.label, media["type"], media["size"]), Color.YELLOW)
+        targets.remove(backend)
+    job.targets = [backend.name for backend in targets]
+
+    failed, running = list(job.targets), {}
+    if job.remaining():
+        tasks = dict((backend.upload(submission.title, url_to_process), backend.name) for backend in targets)
+        on_mirror = None
+        if progressive_comments:
+            # Original plus whatever's done so far, the comment stage sends the final version
+            on_mirror = lambda: add_comment(submission, comment_text(job), final=False)
+        failed, running = collect_mirrors(job.mirror, tasks, on_mirror, timeout=min(mirror_timeout, job.remaining()))
+    else:
+        log("--Out of time for %s, leaving the uploads to the retry queue" % submission.id, Color.YELLOW)
+    if retry_worker and not job.checkpointed:
+        for service in failed:
+            retry_worker.enqueue(submission.id, service, url_to_process, submission.title)
+    if mirror_db:
+        mirror_db.save(job.mirror)
+        if job.fingerprint:
+            mirror_db.save_fingerprint(job.mirror.op_id, job.fingerprint)
+    # Only now, so a late one can't be overwritten by the save above
+    for future, service in running.items():
+        with late_uploads_lock:
+            late_uploads[(submission.id, service)] = job
+        future.add_done_callback(lambda f, s=service: late_mirror_done(job, s, f))
+
+    return job
+
+
+# Stores an upload that outlasted the post's deadline and updates the comment with it, or
+# hands it to the retry queue if it failed
+def late_mirror_done(job, service, future):
+    with late_uploads_lock:
+        if late_uploads.pop((job.submission.id, service), None) is None:
+            # Already handed to the retry queue by retry_late_uploads()
+            return
+    if store_mirror(job.mirror, service, future):
+        if mirror_db:
+            mirror_db.save(job.mirror)
+        add_comment(job.submission, comment_text(job))
+    elif retry_worker and not job.checkpointed:
+        retry_worker.enqueue(job.submission.id, service, job.url_to_process, job.submission.title)
+
+
+# Hands every upload still going past its post's deadline to the retry queue, for a run
+# that's about to exit before they can finish
+def retry_late_uploads():
+    with late_uploads_lock:
+        pending = list(late_uploads.items())
+        late_uploads.clear()
+    for (op_id, service), job in pending:
+        if retry_worker and not job.checkpointed:
+            retry_worker.enqueue(op_id, service, job.url_to_process, job.submission.title)
+
+
+# Full comment for a job's mirrors as they are right now
+def comment_text(job):
+    return comment_intro + job.mirror.comment_string(job.submission.domain) + comment_info
+
+
+# Comment stage
+def comment_on_submission(job):
+    add_comment(job.submission, comment_text(job))
+
+
+# Process a gif post, start to finish on the calling thread. Returns the job, or None if
+# there was nothing to mirror.
+def process_submission(submission):
+    job = resolve_submission(submission)
+    if job:
+        comment_on_submission(mirror_submission(job))
+    return job
+
+
+# Head start in seconds for a post in the pipeline queues. Velocity is votes plus comments
+# (which count double) per minute since it was posted, so a fresh post taking off beats an
+# old one that got there slowly; the stage queues age everything else so nothing starves.
+def submission_priority(submission):
+    try:
+        age_minutes = max(1.0, (time.time() - submission.created_utc) / 60)
+        velocity = max(0, submission.score + 2 * submission.num_comments) / age_minutes
+        weight = sub_weights.get(submission.subreddit.display_name, 1.0)
+    except (AttributeError, TypeError):
+        return 0
+    boost = weight * priority_boost_per_doubling * math.log(1 + velocity, 2)
+    return min(max_priority_boost, boost)
+
+
+# Priority for whatever a stage holds, a submission or a MirrorJob
+def item_priority(item):
+    return submission_priority(getattr(item, "submission", item))
+
+
+# Returns the pipeline, creating it on first use
+def get_pipeline():
+    global pipeline
+    if pipeline is None:
+        pipeline = Pipeline([
+            Stage("discover", discover_stage, stage_workers["discover"], stage_queue_size, item_priority),
+            Stage("resolve", resolve_submission, stage_workers["resolve"], stage_queue_size, item_priority),
+            Stage("mirror", mirror_submission, stage_workers["mirror"], stage_queue_size, item_priority),
+            Stage("comment", comment_on_submission, stage_workers["comment"], stage_queue_size)
+        ])
+        for stage in pipeline.stages:
+            stage.on_drop = release_dropped
+    return pipeline
+
+
+# Uploads to one service and waits for the result, for the retry worker
+def convert_blocking(service, title, url_to_process):
+    return backends[service].upload_blocking(title, url_to_process, timeout=mirror_timeout)
+
+
+# Called by the retry worker when a retried upload worked: stores it and edits our comment
+def retried_mirror_done(op_id, service, url):
+    json_data = mirror_db.find_by_op_id(op_id)
+    if not json_data:
+        return
+    mirror = MirroredObject.from_json(json_data)
+    mirror.set_mirror(service, url)
+    mirror_db.save(mirror)
+    log("--Recovered %s mirror for %s: %s" % (service.capitalize(), op_id, url), Color.GREEN)
+
+    comment_id = mirror_db.comment_id_for(op_id)
+    if comment_id and not dry_run:
+        submission = r.get_submission(submission_id=op_id)
+        comment = r.get_info(thing_id="t1_" + comment_id)
+        comment_string = comment_intro + mirror.comment_string(submission.domain) + comment_info
+        comment_queue.put(submission, comment_string, comment=comment)
+
+
+# Waits on the mirror uploads and stores each result on the mirror as it finishes, calling
+# on_mirror() after each one that worked. A failed or slow service only loses its own
+# mirror, the others are kept. Returns the services that failed, and {future: service} for
+# the uploads still going at the timeout. Those are left to finish rather than cancelled,
+# since one that's started can't be stopped and retrying it would only do it twice.
+def collect_mirrors(new_mirror, tasks, on_mirror=None, timeout=mirror_timeout):
+    failed = []
+    running = {}
+    try:
+        for future in concurrent.futures.as_completed(tasks, timeout=timeout):
+            if store_mirror(new_mirror, tasks[future], future):
+                if on_mirror:
+                    on_mirror()
+            else:
+                failed.append(tasks[future])
+    except concurrent.futures.TimeoutError:
+        for future in tasks:
+            if not future.done():
+                log("--%s conversion is slow, adding it when it's done" % tasks[future].capitalize(), Color.YELLOW)
+                running[future] = tasks[future]
+    return failed, running
+
+
+# Stores the result of one finished upload on the mirror, returns True if it worked
+def store_mirror(new_mirror, service, future):
+    try:
+        url = future.result()
+    except PollTimeout:
+        log("--%s conversion timed out" % service.capitalize(), Color.RED)
+        return False
+    except CircuitOpen:
+        log("--%s is down, skipping" % service.capitalize(), Color.YELLOW)
+        return False
+    except BackendBusy:
+        log("--%s queue is full, skipping" % service.capitalize(), Color.YELLOW)
+        return False
+    except Exception:
+        log("--%s conversion failed" % service.capitalize(), Color.RED)
+        logging.exception("Error converting to " + service)
+        return False
+    if url and url != "Error":
+        new_mirror.set_mirror(service, url)
+        log("--%s url is %s" % (service.capitalize(), url))
+        return True
+    return False
+
+
+# Add the comment with info. Real comments go on the comment queue, which posts them as
+# soon as reddit lets us. Adding again for the same submission edits the comment, final
+# means this is the last version.
+def add_comment(submission, comment_string, final=True):
     log("--Adding comment", Color.BLUE)
 
     if dry_run:
@@ -307,64 +831,433 @@ def add_comment(submission, comment_string):
         log(comment_string, Color.GREEN)
         return
 
+    comment_queue.put(submission, comment_string, final)
+
+
+# Actually posts a comment, called from the comment queue
+@timed("add_comment", "reddit")
+def post_comment(submission, comment_string):
+    comment = submission.add_comment(comment_string)
+    log("--Posted comment on " + submission.id, Color.GREEN)
+    metrics.observe("time_to_comment", time.time() - submission.created_utc)
+    if mirror_db:
+        mirror_db.mark_commented(submission.id, comment.id)
+    if leases:
+        leases.release("post:" + submission.id)
+    return comment
+
+
+# Edits a comment we already posted, called from the comment queue
+@timed("edit_comment", "reddit")
+def edit_comment(comment, comment_string):
+    comment.edit(comment_string)
+    log("--Edited comment " + comment.id, Color.GREEN)
+
+
+# Outbound comments, drained in the background
+comment_queue = CommentQueue(post_comment, limiters["reddit_comment"], edit_comment, limiters["reddit_edit"],
+                             relogin=lambda: password_login(r),
+                             on_failed=lambda submission: release_dropped("comment", submission),
+                             find_comment=lambda submission: find_our_comment(submission))
+
+
+# Our comment on a submission, if we've posted one, so new text for it becomes an edit
+def find_our_comment(submission):
+    comment_id = mirror_db.comment_id_for(submission.id) if mirror_db else None
+    if not comment_id:
+        return None
+    return r.get_info(thing_id="t1_" + comment_id)
+
+
+# Rebuilds the index of commented submissions from the bot account's comment history,
+# newest first. With since, stops at comments older than that.
+def rebuild_comment_index(since=None):
+    log("Rebuilding commented submissions index", Color.BOLD)
+    rows = []
+    for comment in r.get_redditor(bot_name).get_comments(sort='new', limit=None):
+        if since and comment.created_utc < since:
+            break
+        # link_id is the submission's fullname, e.g. "t3_abc123"
+        rows.append((comment.link_id.split('_', 1)[1], comment.id))
+        if len(rows) >= 100:
+            mirror_db.mark_commented_many(rows)
+            rows = []
+    if rows:
+        mirror_db.mark_commented_many(rows)
+    log("--Index has %d submissions" % mirror_db.commented_count(), Color.GREEN)
+
+
+# How far back to look in a subreddit we have no cursor for
+first_run_lookback = 10 * 60
+
+# How far back to catch up in a subreddit whose cursor is old, e.g. after an outage
+max_lookback = 6 * 60 * 60
+
+
+# Finds new posts in all the given subreddits with one combined listing, paging only back
+# to the time each subreddit was last checked through (the newest post in the listing at
+# its last check), so a quiet subreddit doesn't drag the listing back through the busy
+# ones. The fullname of a subreddit's last post only stops it coming up twice. Returns
+# the posts oldest first, and the time the listing is now checked through (None if empty).
+def discover_submissions(subs, cursors):
+    now = time.time()
+    floors = {}
+    for sub in subs:
+        cursor = cursors.get(sub.lower())
+        if cursor:
+            floors[sub.lower()] = (cursor[0], max(cursor[1], cursor[2] or 0, now - max_lookback))
+        else:
+            floors[sub.lower()] = (None, now - first_run_lookback)
+    stop_before = min(floor[1] for floor in floors.values())
+
+    submissions = []
+    checked_through = None
+    multireddit = r.get_subreddit("+".join(subs))
+    for submission in multireddit.get_new(limit=None):
+        if checked_through is None:
+            checked_through = submission.created_utc
+        if submission.created_utc < stop_before:
+            break
+        floor = floors.get(submission.subreddit.display_name.lower())
+        if not floor or submission.created_utc < floor[1] or submission.fullname == floor[0]:
+            continue
+        submissions.append(submission)
+
+    return sorted(submissions, key=lambda p: p.created_utc), checked_through
+
+
+# Loads the subreddit scheduler, with its learned rates if we have them
+def load_sub_scheduler():
+    scheduler = SubredditScheduler(approved_subs)
+    saved = mirror_db.get_state("sub_scheduler") if mirror_db else None
+    if saved:
+        scheduler.loads(saved)
+    return scheduler
+
+
+def save_sub_scheduler():
+    if mirror_db and sub_scheduler:
+        mirror_db.set_state("sub_scheduler", sub_scheduler.dumps())
+
+
+# Main bot runner. Checks the given subreddits, or all of them, and feeds new posts into
+# the pipeline. With wait, returns once they've all gone through it.
+def bot(subs=None, wait=True):
+    subs = subs or approved_subs
+    if leases:
+        subs = claim_subs(subs)
+        if not subs:
+            log("Other workers have every due subreddit", Color.BLUE)
+            return
     try:
-        submission.add_comment(comment_string)
-    except praw.errors.RateLimitExceeded:
-        log("--Rate Limit Exceeded", Color.RED)
-    except praw.errors.APIException:
-        log('--API exception', Color.RED)
-        logging.exception("Error on followupComment")
-
-
-# Main bot runner
-def bot():
-    for sub in approved_subs:
-        log("Checking for posts in /r/" + sub, Color.BLUE)
-        now = datetime.datetime.utcnow()
-        now_minus_10 = now + datetime.timedelta(minutes=-10)
-        float_now_minus_10 = time.mktime(now_minus_10.timetuple())
-        subreddit = r.get_subreddit(sub)
-        submissions = [p for p in subreddit.get_new(limit=200) if p.created_utc > float_now_minus_10]
-        for submission in sorted(submissions, key=lambda p: p.created_utc):
-            is_valid, has_commented = submission_is_valid(submission)
-            log("Analyzing " + submission.title)
-            if is_valid:
-                log("New Post in /r/" + submission.subreddit.display_name + " - " + submission.url, Color.GREEN)
+        submissions = check_subs(subs)
+    finally:
+        if leases:
+            for sub in subs:
+                leases.release("sub:" + sub.lower())
+
+    if len(submissions) == 0:
+        log("Nothing new", Color.BLUE)
+    elif wait:
+        wait_for_pipeline()
+        get_pipeline().log_stats()
+    write_metrics()
+
+
+# Takes the leases on the subreddits no other worker is checking, and puts the rest off
+# for a bit. Returns the ones we got.
+def claim_subs(subs):
+    claimed = []
+    for sub in subs:
+        if leases.acquire("sub:" + sub.lower()):
+            claimed.append(sub)
+        else:
+            log("--Another worker is checking /r/" + sub, Color.BLUE)
+            if sub_scheduler:
+                sub_scheduler.defer(sub, sub_scheduler.min_interval)
+    return claimed
+
+
+# Finds new posts in subs and puts them into the pipeline. Returns them.
+def check_subs(subs):
+    log("Checking for posts in /r/" + "+".join(subs), Color.BLUE)
+    cursors = mirror_db.get_cursors() if mirror_db else {}
+    submissions, checked_through = discover_submissions(subs, cursors)
+
+    if sub_scheduler:
+        for sub in subs:
+            new_posts = len([p for p in submissions if p.subreddit.display_name.lower() == sub.lower()])
+            sub_scheduler.record_check(sub, new_posts)
+        save_sub_scheduler()
+
+    if dry_run:
+        # Only ever do the first valid post, on this thread
+        for submission in submissions:
+            if discover_stage(submission):
                 process_submission(submission)
-                if dry_run:
-                    sys.exit("Done")
-            elif has_commented:
-                return
+                sys.exit("Done")
+    else:
+        for submission in submissions:
+            if shutdown_requested.is_set():
+                return submissions
+            get_pipeline().put(submission)
+            if mirror_db:
+                mirror_db.save_cursor(submission.subreddit.display_name.lower(), submission.fullname,
+                                      submission.created_utc)
+        if mirror_db and checked_through:
+            mirror_db.save_checked_through([sub.lower() for sub in subs], checked_through)
+    return submissions
+
+
+# Waits for the pipeline to empty. Returns False if a shutdown was asked for first.
+def wait_for_pipeline():
+    while not get_pipeline().join(timeout=1):
+        if shutdown_requested.is_set():
+            return False
+    return True
+
+
+# One pass of the retry worker, on its own thread so a shutdown signal doesn't have to wait
+# out the upload it's in the middle of. A job cut off that way is still in the DB, due, for
+# the next run.
+def run_retries_once():
+    thread = threading.Thread(target=retry_worker.run_once, name="retry-worker", daemon=True)
+    thread.start()
+    while thread.is_alive() and not shutdown_requested.is_set():
+        thread.join(1)
+
+
+# Waits for queued comments to post, up to timeout seconds. Returns False if they didn't
+# all go out in time, or a shutdown was asked for first.
+def flush_comments(timeout):
+    deadline = time.time() + timeout
+    while not comment_queue.join(min(1, max(0, deadline - time.time()))):
+        if shutdown_requested.is_set() or time.time() >= deadline:
+            return False
+    return True
+
+
+# Posts whose ids were checkpointed by a run that was shut down before finishing them
+def load_unfinished():
+    saved = mirror_db.get_state("unfinished_submissions") if mirror_db else None
+    return json.loads(saved) if saved else []
+
+
+def save_unfinished(submission_ids):
+    ids = sorted(set(load_unfinished()) | set(submission_ids))
+    mirror_db.set_state("unfinished_submissions", json.dumps(ids))
+    log("--Checkpointed %d unfinished posts for the next run" % len(ids), Color.YELLOW)
+
+
+# Puts the posts an earlier run didn't finish back into the pipeline. Returns how many.
+def resume_unfinished():
+    ids = load_unfinished()
+    if not ids:
+        return 0
+    mirror_db.set_state("unfinished_submissions", json.dumps([]))
+    log("Resuming %d unfinished posts" % len(ids), Color.BLUE)
+    for i in range(0, len(ids), 100):
+        # None when none of them exist any more
+        for submission in r.get_info(thing_id=["t3_" + s_id for s_id in ids[i:i + 100]]) or []:
+            get_pipeline().put(submission)
+    return len(ids)
+
+
+# Post id from a line of backfill input: a bare id, a t3_ fullname or a link to the post.
+# None for blank lines, # comments and anything else.
+def parse_submission_id(line):
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    match = re.search(r"(?:/comments/|redd\.it/)([a-z0-9]+)", line, re.I)
+    if match:
+        return match.group(1).lower()
+    if line.startswith("t3_"):
+        line = line[3:]
+    if re.match(r"^[a-z0-9]+$", line, re.I):
+        return line.lower()
+    log("--Can't find a post id in " + line, Color.YELLOW)
+    return None
+
+
+# Post ids to backfill from a file, or stdin for "-", in order and without repeats
+def read_backfill_ids(source):
+    lines = sys.stdin if source == "-" else open(source, "r")
+    try:
+        ids = []
+        seen = set()
+        for line in lines:
+            s_id = parse_submission_id(line)
+            if s_id and s_id not in seen:
+                seen.add(s_id)
+                ids.append(s_id)
+        return ids
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+
+
+def load_backfill_checkpoint(path):
+    try:
+        with open(path, "r") as checkpoint:
+            return set(line.strip() for line in checkpoint if line.strip())
+    except FileNotFoundError:
+        return set()
+
+
+# Mirrors and comments on a list of past posts, e.g. ones missed during an outage. Posts
+# are looked up in batches and run through process_submission on backfill_workers threads.
+# Each finished post goes into the checkpoint file (once its comment is posted), so running
+# it again with the same input only does what's left. Stops early on a shutdown signal.
+def backfill(source):
+    path = os.environ.get('BACKFILL_CHECKPOINT_PATH', backfill_checkpoint_file)
+    done = load_backfill_checkpoint(path)
+    ids = read_backfill_ids(source)
+    todo = [s_id for s_id in ids if s_id not in done]
+    log("Backfilling %d posts, %d already done" % (len(todo), len(ids) - len(todo)), Color.BOLD)
+
+    counts = {"mirrored": 0, "skipped": 0, "failed": 0}
+    lock = threading.Lock()
+    # Posts whose comment was still queued when they finished
+    waiting = []
+    checkpoint = open(path, "a")
+
+    def mark_done(s_id):
+        if dry_run:
+            return
+        with lock:
+            checkpoint.write(s_id + "\n")
+            checkpoint.flush()
+
+    def run(submission):
+        try:
+            if discover_stage(submission) and process_submission(submission):
+                result = "mirrored"
+            else:
+                # Lets go of the post if discovery claimed it but there was nothing to mirror
+                release_dropped("backfill", submission)
+                result = "skipped"
+        except Exception:
+            log("--Error backfilling " + submission.id, Color.RED)
+            logging.exception("Error backfilling " + submission.id)
+            release_dropped("backfill", submission)
+            result = "failed"
+        with lock:
+            counts[result] += 1
+        if result != "failed":
+            if comment_queue.has_pending(submission.id):
+                with lock:
+                    waiting.append(submission)
             else:
-                continue
+                mark_done(submission.id)
 
-        if len(submissions) == 0:
-            log("Nothing new", Color.BLUE)
+    start = time.time()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=backfill_workers)
+    try:
+        for i in range(0, len(todo), backfill_batch_size):
+            if shutdown_requested.is_set():
+                break
+            names = ["t3_" + s_id for s_id in todo[i:i + backfill_batch_size]]
+            # None when none of them exist
+            submissions = r.get_info(thing_id=names) or []
+            futures = [executor.submit(run, submission) for submission in submissions]
+            # Deleted, removed or mistyped. Checkpointed as skipped so reruns don't ask again.
+            for s_id in set(name[3:] for name in names) - set(submission.id for submission in submissions):
+                log("--%s not found on reddit, skipping" % s_id, Color.YELLOW)
+                with lock:
+                    counts["skipped"] += 1
+                mark_done(s_id)
+            while futures:
+                futures = concurrent.futures.wait(futures, timeout=1).not_done
+                if shutdown_requested.is_set():
+                    for future in futures:
+                        future.cancel()
+            log("--Backfilled %d/%d" % (min(i + backfill_batch_size, len(todo)), len(todo)), Color.BLUE)
+    finally:
+        executor.shutdown(wait=True)
+
+    timeout = shutdown_timeout if shutdown_requested.is_set() else comment_flush_timeout
+    if not comment_queue.join(timeout):
+        log("Gave up on %d queued comments" % comment_queue.pending(), Color.RED)
+    retry_late_uploads()
+    unposted = set(submission.id for submission in comment_queue.unposted())
+    for submission in waiting:
+        if submission.id not in unposted:
+            mark_done(submission.id)
+    checkpoint.close()
+
+    elapsed = time.time() - start
+    total = sum(counts.values())
+    log("Backfilled %d posts in %.1fs (%.1f/min): %d mirrored, %d skipped, %d failed"
+        % (total, elapsed, 60.0 * total / max(1.0, elapsed), counts["mirrored"], counts["skipped"],
+           counts["failed"]), Color.BOLD)
+
+
+# Hands an in-flight mirror job to the retry queue: keeps the mirrors it has, queues the
+# uploads still running and comments with what's there. Returns False if there's nothing
+# to keep yet, in which case the whole post is better redone next run.
+def checkpoint_mirror_job(job):
+    if not any(backend.mirror_url(job.mirror) for backend in backends.mirrors()):
+        return False
+    job.checkpointed = True
+    mirror_db.save(job.mirror)
+    for service in job.targets:
+        if not getattr(job.mirror, service + "_url"):
+            retry_worker.enqueue(job.submission.id, service, job.url_to_process, job.submission.title)
+    # If the mirror stage finishes it after all, the comment stage's text edits this comment
+    # rather than posting another (the comment queue looks ours up once the entry's gone)
+    add_comment(job.submission, comment_text(job))
+    return True
+
+
+# Winds down after a shutdown signal. Discovery has already stopped; in-flight posts get
+# until two thirds of shutdown_timeout to finish, then whatever's left is checkpointed
+# (partly mirrored posts to the retry queue, the rest to be redone next run) and queued
+# comments get the remaining time to post.
+def graceful_shutdown():
+    log("Shutting down, draining the pipeline", Color.BOLD)
+    deadline = time.time() + shutdown_timeout
+    if retry_worker:
+        retry_worker.stop()
+
+    unfinished = []
+    if pipeline and not pipeline.join(timeout=shutdown_timeout * 2 / 3.0):
+        for stage in pipeline.stages:
+            queued, active = stage.take_queued(), stage.in_flight()
+            for item in queued + active:
+                if stage.name == "comment":
+                    # Mirrored already, only the comment is left
+                    add_comment(item.submission, comment_text(item))
+                elif not (stage.name == "mirror" and item in active and checkpoint_mirror_job(item)):
+                    unfinished.append(getattr(item, "submission", item).id)
+
+    if not comment_queue.join(max(0, deadline - time.time())):
+        log("Gave up on %d queued comments" % comment_queue.pending(), Color.RED)
+        unfinished.extend(submission.id for submission in comment_queue.unposted())
+    if unfinished and mirror_db:
+        save_unfinished(unfinished)
+    retry_late_uploads()
 
 
 # Main method
 if __name__ == "__main__":
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "fdn", ["flushvalid", "dry", "notify"])
+        opts, args = getopt.getopt(sys.argv[1:], "fdnrDb:",
+                                   ["flushvalid", "dry", "notify", "rebuildindex", "daemon", "backfill="])
     except getopt.GetoptError:
-        print('bot.py -f -d -n')
+        print('bot.py -f -d -n -r -D -b <file of post ids or urls, - for stdin>')
         sys.exit(2)
 
     if os.environ.get('HEROKU', None):
         running_on_heroku = True
 
-        # TODO Eventually we'll want to DB this instead
-        # urlparse.uses_netloc.append("postgres")
-        # url = urlparse.urlparse(os.environ["DATABASE_URL"])
-        #
-        # conn = psycopg2.connect(
-        # database=url.path[1:],
-        # user=url.username,
-        # password=url.password,
-        # host=url.hostname,
-        # port=url.port
-        # )
+    startup_mark("imports")
+    mirror_db = open_db(os.environ.get('MIRROR_DB_PATH', cache_file))
+    rebuild_index = False
+    backfill_source = None
+    metadata_cache_file = os.environ.get('METADATA_CACHE_PATH', metadata_cache_file)
+    metadata_cache.load(metadata_cache_file)
 
     if len(opts) != 0:
         for o, a in opts:
@@ -372,14 +1265,27 @@ if __name__ == "__main__":
                 dry_run = True
             elif o in ("-n", "--notify"):
                 notify = True
+            elif o in ("-r", "--rebuildindex"):
+                rebuild_index = True
+            elif o in ("-D", "--daemon"):
+                daemon_mode = True
+            elif o in ("-b", "--backfill"):
+                backfill_source = a
             else:
                 sys.exit('No valid args specified')
 
+    startup_mark("db")
+
     # Register the function that get called on exit
     atexit.register(exit_handler)
 
-    # Register function to call on SIGINT
+    register_gauges()
+    if os.environ.get('METRICS_PORT'):
+        start_http_server(int(os.environ['METRICS_PORT']))
+
+    # Register function to call on SIGINT and SIGTERM
     signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
 
     log("Starting Bot", Color.BOLD)
     log("OS is " + sys.platform, Color.BOLD)
@@ -391,29 +1297,82 @@ if __name__ == "__main__":
     args = sys.argv
     loginType = "propFile"
 
-    r = praw.Reddit(user_agent='/u/gfy_mirror by /u/pandanomic')
+    sub_scheduler = load_sub_scheduler()
+    if running_on_heroku and not daemon_mode and not backfill_source and not dry_run and not rebuild_index:
+        # A scheduler tick with nothing to do shouldn't pay for logging in. Only works if
+        # the mirror DB outlives the dyno (MIRROR_DB_PATH on a persistent disk): on a fresh
+        # one every subreddit is due.
+        if not sub_scheduler.due() and not mirror_db.due_retries(time.time(), 1) and not load_unfinished() \
+                and not mirror_db.abandoned_post_ids(time.time(), 1):
+            startup_mark("schedule")
+            log_startup()
+            log("Nothing due, exiting", Color.BLUE)
+            sys.exit()
+    startup_mark("schedule")
 
     log("Retrieving login credentials", Color.BOLD)
-    loginInfo = retrieve_login_credentials()
     try:
-        r.login(loginInfo[0], loginInfo[1], disable_warning=True)
-        log("--Login successful", Color.GREEN)
-    except praw.errors:
+        r = reddit_login()
+    except Exception:
+        logging.exception("Login failed")
         log("LOGIN FAILURE", Color.RED)
         exit_bot()
+    configure_backends()
+    startup_mark("login")
+    log_startup()
+
+    if rebuild_index:
+        rebuild_comment_index()
+    elif mirror_db.commented_count() == 0:
+        # Fresh DB (e.g. a new dyno): discovery never looks further back than max_lookback,
+        # so our comments from that long are all it needs. -r does the whole history.
+        rebuild_comment_index(since=time.time() - max_lookback)
 
-    imgur_client = ImgurClient(loginInfo[3], loginInfo[4])
     counter = 0
+    leases = LeaseManager(mirror_db)
+    retry_worker = RetryWorker(mirror_db, convert_blocking, retried_mirror_done, leases=leases)
 
-    if running_on_heroku:
+    if backfill_source:
+        backfill(backfill_source)
+        sys.exit()
+
+    if not dry_run:
+        resume_unfinished()
+
+    if running_on_heroku and not daemon_mode:
         log("Heroku run", Color.BOLD)
-        bot()
+        sweep_abandoned_posts()
+        due_subs = sub_scheduler.due()
+        if due_subs:
+            bot(due_subs)
+        else:
+            log("No subreddits due yet", Color.BLUE)
+            wait_for_pipeline()
+        if not shutdown_requested.is_set():
+            run_retries_once()
+        if not shutdown_requested.is_set():
+            if not flush_comments(comment_flush_timeout) and not shutdown_requested.is_set():
+                log("Gave up on %d queued comments" % comment_queue.pending(), Color.RED)
+        if shutdown_requested.is_set():
+            graceful_shutdown()
+        else:
+            retry_late_uploads()
     else:
+        # HTTP pools, caches and the reddit session stay warm between passes
         log("Looping", Color.BOLD)
-        while True:
-            bot()
-            counter += 1
-            log('Looped - ' + str(counter), Color.BOLD)
-            if notify:
-                notify_mac("Looped")
-            time.sleep(60)
+        retry_worker.start()
+        last_sweep = 0
+        while not shutdown_requested.is_set():
+            if time.time() - last_sweep >= lease_sweep_interval:
+                sweep_abandoned_posts()
+                last_sweep = time.time()
+            due_subs = sub_scheduler.due()
+            if due_subs:
+                bot(due_subs, wait=False)
+                counter += 1
+                log('Looped - ' + str(counter), Color.BOLD)
+                get_pipeline().log_stats()
+                if notify:
+                    notify_mac("Looped")
+            shutdown_requested.wait(max(1, min(lease_sweep_interval, sub_scheduler.seconds_until_next())))
+        graceful_shutdown()
@@ -0,0 +1,108 @@
+import threading
+import time
+from concurrent.futures import Future
+
+from utils import log, Color
+
+__author__ = 'Henri Sweers'
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+# Raised instead of calling a service whose circuit is open
+class CircuitOpen(Exception):
+    pass
+
+
+# Circuit breaker for one backend. After failure_threshold failures in a row (a call slower
+# than slow_threshold counts as a failure) it opens and every call is skipped. After
+# reset_timeout seconds it lets a single probe call through (half open): if that works
+# it closes again, otherwise it stays open for another reset_timeout.
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=3, slow_threshold=None, reset_timeout=120):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.slow_threshold = slow_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    # Whether a call may go ahead. In half open state only one probe is let through.
+    def allow(self):
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self.probing = False
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def record_success(self, elapsed=None):
+        if self.slow_threshold and elapsed is not None and elapsed > self.slow_threshold:
+            self.record_failure()
+            return
+        with self.lock:
+            if self.state != CLOSED:
+                log("--%s circuit closed" % self.name.capitalize(), Color.GREEN)
+            self.state = CLOSED
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                log("--%s circuit open for %d seconds" % (self.name.capitalize(), self.reset_timeout), Color.RED)
+                self.state = OPEN
+                self.opened_at = time.time()
+
+    # Calls fn through the breaker. A falsy or "Error" result counts as a failure. If fn
+    # returns a future, the outcome is recorded when it finishes.
+    def call(self, fn, *args, **kwargs):
+        if not self.allow():
+            raise CircuitOpen(self.name)
+        start = time.time()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+
+        if isinstance(result, Future):
+            result.add_done_callback(lambda f: self._record_future(f, start))
+        else:
+            self._record(result, start)
+        return result
+
+    def _record(self, result, start):
+        if result and result != "Error":
+            self.record_success(time.time() - start)
+        else:
+            self.record_failure()
+
+    def _record_future(self, future, start):
+        if future.cancelled() or future.exception() is not None:
+            self.record_failure()
+        else:
+            self._record(future.result(), start)
+
+
+# One breaker per backend. Slow thresholds sit at three quarters of each backend's polling
+# timeout (backend_settings), so a host that's dragging trips the breaker before it just
+# times out.
+breakers = {
+    "gfycat": CircuitBreaker("gfycat", slow_threshold=45),
+    "offsided": CircuitBreaker("offsided", slow_threshold=45),
+    "streamable": CircuitBreaker("streamable", slow_threshold=22),
+    "imgur": CircuitBreaker("imgur", slow_threshold=22),
+    "vine": CircuitBreaker("vine", slow_threshold=11)
+}
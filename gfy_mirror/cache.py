@@ -0,0 +1,92 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+__author__ = 'Henri Sweers'
+
+
+# Raised when a lookup failed, either just now or recently enough that it's negatively cached
+class MetadataUnavailable(Exception):
+    pass
+
+
+# Bounded LRU cache for service metadata, with a TTL per service and short-lived negative
+# entries for lookups that failed. Can be saved to and loaded from a json file so info
+# survives between scheduler runs.
+class MetadataCache:
+    def __init__(self, max_entries=2000, ttls=None, default_ttl=600, negative_ttl=60):
+        self.max_entries = max_entries
+        self.ttls = ttls or {}
+        self.default_ttl = default_ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+
+    # Returns the cached value for (service, key), calling loader() on a miss. Failures
+    # are cached for negative_ttl seconds and raise MetadataUnavailable.
+    def get(self, service, key, loader):
+        cache_key = "%s:%s" % (service, key)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            if entry and entry[0] > now:
+                self.entries.move_to_end(cache_key)
+                if entry[2]:
+                    self.negative_hits += 1
+                    raise MetadataUnavailable(cache_key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        try:
+            value = loader()
+        except Exception as e:
+            self.put(cache_key, None, self.negative_ttl, negative=True)
+            raise MetadataUnavailable("%s (%s)" % (cache_key, e))
+
+        self.put(cache_key, value, self.ttls.get(service, self.default_ttl))
+        return value
+
+    def put(self, cache_key, value, ttl, negative=False):
+        with self.lock:
+            self.entries[cache_key] = (time.time() + ttl, value, negative)
+            self.entries.move_to_end(cache_key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "negative_hits": self.negative_hits,
+                    "size": len(self.entries)}
+
+    # Writes the live positive entries to a json file
+    def save(self, path):
+        now = time.time()
+        with self.lock:
+            data = [[k, e[0], e[1]] for k, e in self.entries.items() if e[0] > now and not e[2]]
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as cache_file:
+            json.dump(data, cache_file)
+        os.replace(tmp_path, path)
+
+    # Loads entries saved with save(), dropping the ones that have expired since
+    def load(self, path):
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, "r") as cache_file:
+                data = json.load(cache_file)
+        except ValueError:
+            return
+        now = time.time()
+        with self.lock:
+            for cache_key, expires, value in data:
+                if expires > now:
+                    self.entries[cache_key] = (expires, value, False)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
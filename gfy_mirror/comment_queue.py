@@ -0,0 +1,181 @@
+import logging
+import threading
+import time
+from collections import deque
+
+from utils import log, Color
+
+__author__ = 'Henri Sweers'
+
+
+# Our comment on one submission: posted once, then edited as more mirrors come in
+class CommentEntry:
+    def __init__(self, submission, text, final):
+        self.submission = submission
+        self.text = text
+        self.final = final
+        self.comment = None
+        self.posted_text = None
+        self.ready_at = 0.0
+        self.queued = False
+        self.relogged = False
+
+
+# Outbound comments, posted by a background thread as fast as reddit allows. Each
+# submission has one entry. Putting text for a submission whose comment hasn't gone out
+# yet just replaces the text, and once it's posted further puts become edits, held back
+# for edit_delay seconds so a burst of finished mirrors turns into a single edit. When
+# reddit says we're rate limited the bucket is blocked for as long as it asks and the
+# entry stays queued, so nothing else has to wait.
+class CommentQueue:
+    def __init__(self, post_comment, limiter, edit_comment=None, edit_limiter=None, edit_delay=5,
+                 relogin=None, on_failed=None, find_comment=None):
+        self.post_comment = post_comment
+        self.limiter = limiter
+        self.edit_comment = edit_comment
+        self.edit_limiter = edit_limiter or limiter
+        self.edit_delay = edit_delay
+        # Called to log in again when reddit says we aren't
+        self.relogin = relogin
+        # on_failed(submission), when its comment couldn't be posted and won't be retried
+        self.on_failed = on_failed
+        # find_comment(submission) -> the comment we already posted there or None, so text
+        # put after its entry is gone (it went out as final) edits it instead of posting again
+        self.find_comment = find_comment
+        self.entries = {}
+        self.items = deque()
+        self.in_flight = 0
+        self.cond = threading.Condition()
+        self.thread = None
+
+    # Queues the comment text for a submission. final means no more updates will follow.
+    # Pass the comment to edit one we posted in an earlier run.
+    def put(self, submission, comment_string, final=True, comment=None):
+        if comment is None and self.find_comment:
+            with self.cond:
+                known = submission.id in self.entries
+            if not known:
+                comment = self._find_comment(submission)
+        with self.cond:
+            entry = self.entries.get(submission.id)
+            if entry is None:
+                entry = CommentEntry(submission, comment_string, final)
+                entry.comment = comment
+                self.entries[submission.id] = entry
+            else:
+                entry.text = comment_string
+                entry.final = entry.final or final
+                if entry.comment is not None:
+                    entry.ready_at = max(entry.ready_at, time.time() + self.edit_delay)
+            if not entry.queued:
+                entry.queued = True
+                self.items.append(submission.id)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="comment-queue", daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+
+    def _find_comment(self, submission):
+        try:
+            return self.find_comment(submission)
+        except Exception:
+            logging.exception("Error looking up our comment on " + submission.id)
+            return None
+
+    # Whether a comment for this submission is waiting to be posted
+    def has_pending(self, submission_id):
+        with self.cond:
+            entry = self.entries.get(submission_id)
+            return entry is not None and entry.comment is None
+
+    # Submissions whose comment hasn't been posted yet
+    def unposted(self):
+        with self.cond:
+            return [entry.submission for entry in self.entries.values() if entry.comment is None]
+
+    def pending(self):
+        with self.cond:
+            return len(self.items) + self.in_flight
+
+    # Waits until every queued comment and edit is done, or timeout seconds. Returns True if drained.
+    def join(self, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.cond:
+            while self.items or self.in_flight:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    # Finds the first entry that can go now. Returns (entry, 0) or (None, seconds to wait).
+    def _next_ready(self):
+        now = time.time()
+        wait = 1.0
+        for submission_id in self.items:
+            entry = self.entries[submission_id]
+            limiter = self.limiter if entry.comment is None else self.edit_limiter
+            delay = max(entry.ready_at - now, limiter.delay())
+            if delay <= 0 and limiter.try_acquire():
+                self.items.remove(submission_id)
+                return entry, 0
+            wait = min(wait, max(delay, 0.01))
+        return None, wait
+
+    def _run(self):
+        # Imported here so runs that never comment don't pay for it
+        import praw
+        while True:
+            with self.cond:
+                entry, wait = self._next_ready()
+                if entry is None:
+                    self.cond.wait(wait if self.items else None)
+                    continue
+                entry.queued = False
+                text = entry.text
+                self.in_flight += 1
+
+            requeue = False
+            failed = False
+            try:
+                if entry.comment is None:
+                    entry.comment = self.post_comment(entry.submission, text)
+                elif text != entry.posted_text and self.edit_comment:
+                    self.edit_comment(entry.comment, text)
+                entry.posted_text = text
+            except praw.errors.RateLimitExceeded as e:
+                log("--Rate Limit Exceeded, retrying in %d seconds" % e.sleep_time, Color.RED)
+                (self.limiter if entry.comment is None else self.edit_limiter).penalize(e.sleep_time)
+                requeue = True
+            except praw.errors.NotLoggedIn:
+                log('--Not logged in', Color.RED)
+                # Once per entry, so a login that doesn't help can't loop
+                if self.relogin and not entry.relogged:
+                    entry.relogged = True
+                    try:
+                        self.relogin()
+                        requeue = True
+                    except Exception:
+                        logging.exception("Error logging in again")
+            except praw.errors.APIException:
+                log('--API exception', Color.RED)
+                logging.exception("Error on followupComment")
+            except Exception:
+                log('--Error posting comment', Color.RED)
+                logging.exception("Error posting comment")
+            finally:
+                with self.cond:
+                    self.in_flight -= 1
+                    if requeue and not entry.queued:
+                        entry.queued = True
+                        self.items.appendleft(entry.submission.id)
+                    elif not entry.queued and (entry.final or entry.comment is None):
+                        # Done with it, or the post failed for good
+                        self.entries.pop(entry.submission.id, None)
+                        failed = entry.comment is None
+                    self.cond.notify_all()
+                if failed and self.on_failed:
+                    try:
+                        self.on_failed(entry.submission)
+                    except Exception:
+                        logging.exception("Error handling failed comment")
@@ -0,0 +1,51 @@
+import hashlib
+
+import net
+
+__author__ = 'Henri Sweers'
+
+# Bytes hashed for the cheap signature
+prefix_size = 64 * 1024
+
+# Chunk size used while streaming
+chunk_size = 64 * 1024
+
+# Don't bother hashing anything bigger than this
+max_fingerprint_size = 100 * 1024 * 1024
+
+
+# Content fingerprint of a piece of media. The signature is "<size>:<sha1 of the first
+# 64KB>" and narrows the lookup down, the full hash is the sha1 of the whole file and is
+# what confirms a match.
+class Fingerprint:
+    def __init__(self, signature, full_hash=None):
+        self.signature = signature
+        self.full_hash = full_hash
+
+
+# Streams the media at url once and fingerprints it, never holding more than one chunk in
+# memory. Reads all of it even for media we haven't seen, since this is the copy later
+# reposts will be confirmed against. Returns None if the media is too big or the size
+# isn't known up front.
+def fingerprint_media(url):
+    response = net.get("media", url, stream=True)
+    try:
+        response.raise_for_status()
+        length = response.headers.get('content-length')
+        if not length or int(length) > max_fingerprint_size:
+            return None
+
+        prefix_hash = hashlib.sha1()
+        full_hash = hashlib.sha1()
+        read = 0
+        for chunk in response.iter_content(chunk_size):
+            if read < prefix_size:
+                prefix_hash.update(chunk[:prefix_size - read])
+            full_hash.update(chunk)
+            read += len(chunk)
+            if read > max_fingerprint_size:
+                return None
+
+        return Fingerprint("%s:%s" % (length, prefix_hash.hexdigest()), full_hash.hexdigest())
+    finally:
+        response.close()
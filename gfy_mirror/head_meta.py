@@ -0,0 +1,53 @@
+import codecs
+from html.parser import HTMLParser
+
+import net
+
+__author__ = 'Henri Sweers'
+
+# Stop reading a page after this much, in case it has no </head>
+max_head_bytes = 256 * 1024
+
+
+# Collects <meta property/name=... content=...> tags from a page's head. done is set at
+# </head> (or the first tag of the body), or as soon as every wanted tag has been seen.
+class HeadMetaParser(HTMLParser):
+    def __init__(self, wanted=None):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.wanted = set(wanted or ())
+        self.meta = {}
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "meta":
+            attrs = dict(attrs)
+            key = attrs.get("property") or attrs.get("name")
+            if key and attrs.get("content") is not None:
+                self.meta.setdefault(key, attrs["content"])
+                if self.wanted and self.wanted.issubset(self.meta):
+                    self.done = True
+        elif tag == "body":
+            self.done = True
+
+    def handle_endtag(self, tag):
+        if tag == "head":
+            self.done = True
+
+
+# Streams a page and returns {property or name: content} for the meta tags in its head,
+# reading only as far as it needs to
+def fetch_head_meta(url, wanted=None, service="default", chunk_size=4096):
+    r = net.get(service, url, stream=True)
+    try:
+        r.raise_for_status()
+        decoder = codecs.getincrementaldecoder(r.encoding or "utf-8")(errors="replace")
+        parser = HeadMetaParser(wanted)
+        read = 0
+        for chunk in r.iter_content(chunk_size=chunk_size):
+            parser.feed(decoder.decode(chunk))
+            read += len(chunk)
+            if parser.done or read >= max_head_bytes:
+                break
+        return parser.meta
+    finally:
+        r.close()
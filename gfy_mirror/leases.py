@@ -0,0 +1,89 @@
+import logging
+import os
+import socket
+import threading
+import time
+
+from utils import log, Color
+
+__author__ = 'Henri Sweers'
+
+
+# This process's name in the leases table
+def worker_id():
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+# Time-limited leases in the mirror DB, so several workers sharing it split the work
+# instead of doubling it. A lease ("sub:soccer", "post:abc123", ...) belongs to one worker
+# until it's released or expires; a worker that dies just stops renewing, and its work is
+# up for grabs ttl seconds later. Held leases are renewed every renew_interval seconds in
+# the background, up to max_hold seconds so anything we forget to release still frees up.
+class LeaseManager:
+    def __init__(self, mirror_db, owner=None, ttl=2 * 60, renew_interval=40, max_hold=30 * 60):
+        self.mirror_db = mirror_db
+        self.owner = owner or worker_id()
+        self.ttl = ttl
+        self.renew_interval = renew_interval
+        self.max_hold = max_hold
+        # name -> when we first took it
+        self.held = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    # Takes the lease if it's free, expired or already ours. Returns True if we hold it.
+    def acquire(self, name):
+        now = time.time()
+        if not self.mirror_db.acquire_lease(name, self.owner, now + self.ttl, now):
+            return False
+        with self.lock:
+            self.held.setdefault(name, now)
+        self.start()
+        return True
+
+    def release(self, name):
+        with self.lock:
+            self.held.pop(name, None)
+        self.mirror_db.release_lease(name, self.owner)
+
+    def holds(self, name):
+        with self.lock:
+            return name in self.held
+
+    # Renews everything we hold, letting go of leases held past max_hold. Returns the
+    # names we lost to another worker.
+    def renew(self):
+        now = time.time()
+        with self.lock:
+            stale = [name for name, since in self.held.items() if now - since > self.max_hold]
+            names = [name for name in self.held if name not in stale]
+        for name in stale:
+            log("--Dropping lease on %s, held too long" % name, Color.YELLOW)
+            self.release(name)
+        lost = [name for name in names if not self.mirror_db.acquire_lease(name, self.owner, now + self.ttl, now)]
+        with self.lock:
+            for name in lost:
+                self.held.pop(name, None)
+        for name in lost:
+            log("--Lost lease on %s to another worker" % name, Color.RED)
+        return lost
+
+    # Releases everything, e.g. on shutdown
+    def release_all(self):
+        self.stopped.set()
+        with self.lock:
+            self.held.clear()
+        self.mirror_db.release_leases(self.owner)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="lease-renewer", daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.renew_interval):
+            try:
+                self.renew()
+            except Exception:
+                logging.exception("Error renewing leases")
@@ -0,0 +1,215 @@
+import functools
+import os
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+__author__ = 'Henri Sweers'
+
+prefix = "gfy_mirror_"
+
+# Histogram buckets, in seconds
+buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+
+def label_string(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, v) for k, v in sorted(labels.items()))
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    # Upper bound of the bucket holding the given percentile
+    def percentile(self, pct):
+        target = pct / 100.0 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                return buckets[i] if i < len(buckets) else self.max
+        return 0.0
+
+
+# Counters, gauges and latency histograms, rendered in the Prometheus text format
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.gauge_fns = {}
+        self.histograms = {}
+
+    def inc(self, name, labels=None, value=1):
+        key = (name, label_string(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, labels=None):
+        with self.lock:
+            self.gauges[(name, label_string(labels))] = value
+
+    # Registers a gauge that's read when rendering, e.g. a queue's length
+    def gauge_fn(self, name, fn, labels=None):
+        with self.lock:
+            self.gauge_fns[(name, label_string(labels))] = fn
+
+    def observe(self, name, value, labels=None):
+        key = (name, label_string(labels))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append("%s%s_total%s %d" % (prefix, name, labels, value))
+            gauges = dict(self.gauges)
+            gauge_fns = dict(self.gauge_fns)
+            histograms = sorted(self.histograms.items())
+            for (name, labels), h in histograms:
+                inner = labels[1:-1] + "," if labels else ""
+                cumulative = 0
+                for bound, count in zip(buckets + ["+Inf"], h.counts):
+                    cumulative += count
+                    lines.append('%s%s_seconds_bucket{%sle="%s"} %d' % (prefix, name, inner, bound, cumulative))
+                lines.append("%s%s_seconds_sum%s %f" % (prefix, name, labels, h.total))
+                lines.append("%s%s_seconds_count%s %d" % (prefix, name, labels, h.count))
+        for (name, labels), fn in sorted(gauge_fns.items()):
+            try:
+                gauges[(name, labels)] = fn()
+            except Exception:
+                continue
+        for (name, labels), value in sorted(gauges.items()):
+            lines.append("%s%s%s %s" % (prefix, name, labels, value))
+        return "\n".join(lines) + "\n"
+
+    # Human readable summary, one line per histogram
+    def summary(self):
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        lines = []
+        for (name, labels), h in histograms:
+            lines.append("%s%s: %d calls, avg %.2fs, p50 <=%.2fs, p95 <=%.2fs, max %.2fs" % (
+                name, labels, h.count, h.total / h.count if h.count else 0,
+                h.percentile(50), h.percentile(95), h.max))
+        for (name, labels), value in counters:
+            lines.append("%s%s: %d" % (name, labels, value))
+        return lines
+
+    def write_file(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as metrics_file:
+            metrics_file.write(self.render())
+        os.replace(tmp_path, path)
+
+
+metrics = Registry()
+
+
+# What a call's outcome counts as. Conversions return None or "Error" when they fail.
+def outcome(result=None, error=None, empty_is_error=False):
+    if error is not None:
+        return "timeout" if type(error).__name__.endswith("Timeout") else "error"
+    if empty_is_error and (not result or result == "Error"):
+        return "error"
+    return "success"
+
+
+def record(name, service, start, result=None, error=None, empty_is_error=False):
+    labels = {"service": service} if service else None
+    metrics.observe(name, time.time() - start, labels)
+    call_labels = dict(labels or {}, result=outcome(result, error, empty_is_error))
+    metrics.inc(name, call_labels)
+
+
+# Decorator that records a latency histogram and success/error/timeout counts for a call.
+# If the call returns a future (e.g. a conversion waiting on the poll scheduler), it's
+# recorded when the future finishes and counted as in flight until then. With
+# empty_is_error, a None result counts as an error.
+def timed(name, service=None, empty_is_error=False):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                record(name, service, start, error=e)
+                raise
+            if isinstance(result, Future):
+                track_future(name, service, start, result, empty_is_error)
+            else:
+                record(name, service, start, result=result, empty_is_error=empty_is_error)
+            return result
+        return wrapper
+    return decorator
+
+
+in_flight = {}
+in_flight_lock = threading.Lock()
+
+
+def track_future(name, service, start, future, empty_is_error=False):
+    key = service or name
+    with in_flight_lock:
+        in_flight[key] = in_flight.get(key, 0) + 1
+    metrics.set_gauge("in_flight_jobs", in_flight[key], {"service": key})
+
+    def on_done(f):
+        with in_flight_lock:
+            in_flight[key] -= 1
+        metrics.set_gauge("in_flight_jobs", in_flight[key], {"service": key})
+        if f.cancelled():
+            record(name, service, start, error=Exception("cancelled"))
+        elif f.exception() is not None:
+            record(name, service, start, error=f.exception())
+        else:
+            record(name, service, start, result=f.result(), empty_is_error=empty_is_error)
+
+    future.add_done_callback(on_done)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+# Serves the metrics at http://<host>:<port>/metrics from a background thread
+def start_http_server(port, host="0.0.0.0"):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            found = self.path.startswith("/metrics")
+            body = metrics.render().encode("utf-8") if found else b""
+            self.send_response(200 if found else 404)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
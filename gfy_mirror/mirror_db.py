@@ -0,0 +1,267 @@
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+
+from utils import get_id
+
+__author__ = 'Henri Sweers'
+
+# Every column that holds a url we can look a mirror up by
+url_columns = ["original_url", "gfycat_url", "offsided_url", "streamable_url", "imgur_url"]
+
+
+# Reduces a url to the identity of the media behind it, so http/https, www., trailing
+# slashes, query strings and the different gfycat/imgur hosts all map to the same key
+def normalize_url(url):
+    if not url:
+        return None
+    parsed = urlparse(url if "//" in url else "//" + url)
+    host = parsed.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    path = parsed.path.rstrip('/')
+    if host.endswith("gfycat.com"):
+        return "gfycat.com/" + get_id(path)
+    if host.endswith("imgur.com"):
+        return "imgur.com/" + get_id(path)
+    return host + path
+
+
+# Local sqlite store with one row per MirroredObject, indexed by op id and by every url
+class MirrorDB:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.create_tables()
+
+    def create_tables(self):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS mirrors ("
+                "op_id TEXT PRIMARY KEY, %s, data TEXT NOT NULL, created REAL NOT NULL)"
+                % ", ".join(c + " TEXT" for c in url_columns))
+            for column in url_columns:
+                self.conn.execute("CREATE INDEX IF NOT EXISTS mirrors_%s ON mirrors (%s)" % (column, column))
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS fingerprints ("
+                "op_id TEXT NOT NULL, signature TEXT NOT NULL, full_hash TEXT)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS fingerprints_signature ON fingerprints (signature)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS commented ("
+                "submission_id TEXT PRIMARY KEY, comment_id TEXT, created REAL NOT NULL)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS cursors ("
+                "subreddit TEXT PRIMARY KEY, last_fullname TEXT, last_created REAL NOT NULL, checked_through REAL)")
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(cursors)")]
+            if "checked_through" not in columns:
+                self.conn.execute("ALTER TABLE cursors ADD COLUMN checked_through REAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS retry_jobs ("
+                "id INTEGER PRIMARY KEY, op_id TEXT NOT NULL, service TEXT NOT NULL, source_url TEXT NOT NULL, "
+                "title TEXT, attempts INTEGER NOT NULL, next_attempt REAL NOT NULL, created REAL NOT NULL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS retry_jobs_next ON retry_jobs (next_attempt)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)")
+
+    # Stores or replaces the row for a mirror
+    def save(self, mirror):
+        self.save_many([mirror])
+
+    # Stores or replaces the rows for a batch of mirrors, in one transaction
+    def save_many(self, mirrors):
+        now = time.time()
+        rows = [[m.op_id] + [normalize_url(getattr(m, c)) for c in url_columns] + [m.to_json(), now]
+                for m in mirrors]
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO mirrors (op_id, %s, data, created) VALUES (?, %s, ?, ?)"
+                % (", ".join(url_columns), ", ".join("?" for _ in url_columns)), rows)
+
+    # Returns the json data for a given op id, or None
+    def find_by_op_id(self, op_id):
+        with self.lock:
+            row = self.conn.execute("SELECT data FROM mirrors WHERE op_id = ?", (op_id,)).fetchone()
+        return row[0] if row else None
+
+    # Returns the json data of a mirror where the url is either the original or one of
+    # the mirrors, or None
+    def find_by_url(self, url):
+        key = normalize_url(url)
+        if not key:
+            return None
+        with self.lock:
+            for column in url_columns:
+                row = self.conn.execute(
+                    "SELECT data FROM mirrors WHERE %s = ? ORDER BY created DESC LIMIT 1" % column,
+                    (key,)).fetchone()
+                if row:
+                    return row[0]
+        return None
+
+    # Records the content fingerprint of a mirrored post
+    def save_fingerprint(self, op_id, fingerprint):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT INTO fingerprints (op_id, signature, full_hash) VALUES (?, ?, ?)",
+                              (op_id, fingerprint.signature, fingerprint.full_hash))
+
+    # Returns the json data of a mirror with the same content, or None. A match needs the
+    # same full hash; rows without one (stored before full hashes were always kept) only
+    # count with signature_only, since size and the first 64KB don't prove much.
+    def find_by_fingerprint(self, fingerprint, signature_only=False):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT m.data FROM fingerprints f JOIN mirrors m ON m.op_id = f.op_id "
+                "WHERE f.signature = ? AND (f.full_hash = ? OR (? AND f.full_hash IS NULL)) "
+                "ORDER BY f.full_hash IS NULL, m.created DESC LIMIT 1",
+                (fingerprint.signature, fingerprint.full_hash, int(signature_only))).fetchone()
+        return row[0] if row else None
+
+    # Records that we've commented on a submission
+    def mark_commented(self, submission_id, comment_id=None):
+        self.mark_commented_many([(submission_id, comment_id)])
+
+    # Bulk version of mark_commented, takes (submission_id, comment_id) pairs
+    def mark_commented_many(self, rows):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO commented (submission_id, comment_id, created) VALUES (?, ?, ?)",
+                [(submission_id, comment_id, now) for submission_id, comment_id in rows])
+
+    def has_commented(self, submission_id):
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM commented WHERE submission_id = ?",
+                                    (submission_id,)).fetchone()
+        return row is not None
+
+    # Returns the id of our comment on a submission, or None
+    def comment_id_for(self, submission_id):
+        with self.lock:
+            row = self.conn.execute("SELECT comment_id FROM commented WHERE submission_id = ?",
+                                    (submission_id,)).fetchone()
+        return row[0] if row else None
+
+    def commented_count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM commented").fetchone()[0]
+
+    # Returns {subreddit: (last_fullname, last_created_utc, checked_through)} for every
+    # subreddit we've seen. checked_through can be None.
+    def get_cursors(self):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT subreddit, last_fullname, last_created, checked_through FROM cursors").fetchall()
+        return dict((row[0], (row[1], row[2], row[3])) for row in rows)
+
+    # Moves a subreddit's cursor to the given submission
+    def save_cursor(self, subreddit, fullname, created_utc):
+        with self.lock, self.conn:
+            updated = self.conn.execute(
+                "UPDATE cursors SET last_fullname = ?, last_created = ? WHERE subreddit = ?",
+                (fullname, created_utc, subreddit)).rowcount
+            if not updated:
+                self.conn.execute(
+                    "INSERT INTO cursors (subreddit, last_fullname, last_created) VALUES (?, ?, ?)",
+                    (subreddit, fullname, created_utc))
+
+    # Records that every post in these subreddits up to checked_through has been seen
+    def save_checked_through(self, subreddits, checked_through):
+        with self.lock, self.conn:
+            for subreddit in subreddits:
+                updated = self.conn.execute(
+                    "UPDATE cursors SET checked_through = ? WHERE subreddit = ?",
+                    (checked_through, subreddit)).rowcount
+                if not updated:
+                    self.conn.execute(
+                        "INSERT INTO cursors (subreddit, last_fullname, last_created, checked_through) "
+                        "VALUES (?, NULL, 0, ?)", (subreddit, checked_through))
+
+    # Small key/value store for bits of bot state that need to survive between runs
+    def get_state(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, key, value):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, value))
+
+    # Queues a failed mirror upload to be retried, unless it's already queued
+    def add_retry(self, op_id, service, source_url, title, next_attempt):
+        with self.lock, self.conn:
+            exists = self.conn.execute("SELECT 1 FROM retry_jobs WHERE op_id = ? AND service = ?",
+                                       (op_id, service)).fetchone()
+            if not exists:
+                self.conn.execute(
+                    "INSERT INTO retry_jobs (op_id, service, source_url, title, attempts, next_attempt, created) "
+                    "VALUES (?, ?, ?, ?, 0, ?, ?)", (op_id, service, source_url, title, next_attempt, time.time()))
+
+    # Returns up to limit (id, op_id, service, source_url, title, attempts) rows that are due
+    def due_retries(self, now, limit):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT id, op_id, service, source_url, title, attempts FROM retry_jobs "
+                "WHERE next_attempt <= ? ORDER BY next_attempt LIMIT ?", (now, limit)).fetchall()
+
+    def reschedule_retry(self, job_id, next_attempt):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE retry_jobs SET attempts = attempts + 1, next_attempt = ? WHERE id = ?",
+                              (next_attempt, job_id))
+
+    def delete_retry(self, job_id):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM retry_jobs WHERE id = ?", (job_id,))
+
+    # Drops retries created before the given time, returns how many
+    def expire_retries(self, created_before):
+        with self.lock, self.conn:
+            return self.conn.execute("DELETE FROM retry_jobs WHERE created < ?", (created_before,)).rowcount
+
+    # Takes or renews a lease for owner until expires, if nobody else holds an unexpired
+    # one. Returns True if owner holds it now. BEGIN IMMEDIATE takes the write lock before
+    # the read, so two processes can't both see the lease free.
+    def acquire_lease(self, name, owner, expires, now):
+        with self.lock, self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            row = self.conn.execute("SELECT owner, expires FROM leases WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                self.conn.execute("INSERT INTO leases (name, owner, expires) VALUES (?, ?, ?)", (name, owner, expires))
+            elif row[0] == owner or row[1] < now:
+                self.conn.execute("UPDATE leases SET owner = ?, expires = ? WHERE name = ?", (owner, expires, name))
+            else:
+                return False
+            return True
+
+    def release_lease(self, name, owner):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    # Ids of posts whose lease expired without us ever commenting on them, i.e. a worker
+    # claimed them and died
+    def abandoned_post_ids(self, now, limit=100):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT substr(name, 6) FROM leases WHERE name LIKE 'post:%' AND expires < ? "
+                "AND substr(name, 6) NOT IN (SELECT submission_id FROM commented) LIMIT ?",
+                (now, limit)).fetchall()
+        return [row[0] for row in rows]
+
+    def release_leases(self, owner):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM leases WHERE owner = ?", (owner,))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+# Opens the DB, creating its directory if needed
+def open_db(path):
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    return MirrorDB(path)
@@ -0,0 +1,159 @@
+import threading
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from requests.packages.urllib3.poolmanager import PoolManager, SSL_KEYWORDS
+from requests.packages.urllib3.util.retry import Retry
+
+from ratelimit import limiters
+
+__author__ = 'Henri Sweers'
+
+# (connect, read) timeouts per service, in seconds
+timeouts = {
+    "gfycat": (5, 30),
+    "offsided": (5, 30),
+    "streamable": (5, 30),
+    "imgur": (5, 30),
+    "vine": (5, 15),
+    "media": (5, 30),
+    "default": (5, 20)
+}
+
+# Connections kept alive per host
+pool_size = 10
+
+# Retries for idempotent requests (GET, HEAD etc). POSTs are never retried.
+max_retries = 3
+retry_backoff = 0.5
+
+# Lets a host be pointed somewhere else, e.g. {"upload.gfycat.com": "http://127.0.0.1:8000"}
+host_overrides = {}
+
+
+# Connection counters, shared by every pool
+class ConnectionStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.requests = 0
+
+    def count(self, opened=0, requests_made=0):
+        with self.lock:
+            self.opened += opened
+            self.requests += requests_made
+
+    def snapshot(self):
+        with self.lock:
+            return {"opened": self.opened, "reused": max(0, self.requests - self.opened), "requests": self.requests}
+
+
+stats = ConnectionStats()
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        stats.count(opened=1)
+        return super(CountingHTTPConnectionPool, self)._new_conn()
+
+    def _get_conn(self, timeout=None):
+        stats.count(requests_made=1)
+        return super(CountingHTTPConnectionPool, self)._get_conn(timeout)
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        stats.count(opened=1)
+        return super(CountingHTTPSConnectionPool, self)._new_conn()
+
+    def _get_conn(self, timeout=None):
+        stats.count(requests_made=1)
+        return super(CountingHTTPSConnectionPool, self)._get_conn(timeout)
+
+
+# PoolManager that makes counting pools. Builds them itself rather than through
+# pool_classes_by_scheme, which older urllib3 (the one bundled with requests 2.8) reads
+# from the module instead of the instance.
+class CountingPoolManager(PoolManager):
+    counting_pool_classes = {
+        "http": CountingHTTPConnectionPool,
+        "https": CountingHTTPSConnectionPool
+    }
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        if request_context is None:
+            request_context = self.connection_pool_kw.copy()
+        kwargs = dict(request_context)
+        for key in ("scheme", "host", "port"):
+            kwargs.pop(key, None)
+        if scheme == "http":
+            for kw in SSL_KEYWORDS:
+                kwargs.pop(kw, None)
+        return self.counting_pool_classes[scheme](host, port, **kwargs)
+
+
+# Adapter that keeps a pool of connections per host and counts them
+class PooledAdapter(HTTPAdapter):
+    def init_poolmanager(self, connections, maxsize, *args, **kwargs):
+        super(PooledAdapter, self).init_poolmanager(connections, maxsize, *args, **kwargs)
+        default = self.poolmanager
+        self.poolmanager = CountingPoolManager(num_pools=connections, headers=default.headers,
+                                               **default.connection_pool_kw)
+
+
+_sessions = {}
+_session_lock = threading.Lock()
+
+
+# The shared sessions, one that retries and one that doesn't. requests.Session is safe to
+# share between threads for plain requests, and its adapters keep one pool per host.
+def session(retry=True):
+    with _session_lock:
+        if retry not in _sessions:
+            if retry:
+                max_retry = Retry(total=max_retries, connect=max_retries, read=max_retries,
+                                  backoff_factor=retry_backoff, status_forcelist=[500, 502, 503, 504])
+            else:
+                max_retry = 0
+            adapter = PooledAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=max_retry)
+            s = requests.Session()
+            s.mount("http://", adapter)
+            s.mount("https://", adapter)
+            _sessions[retry] = s
+        return _sessions[retry]
+
+
+def rewrite_url(url):
+    if not host_overrides:
+        return url
+    parsed = urlparse(url)
+    override = host_overrides.get(parsed.netloc)
+    if not override:
+        return url
+    rest = parsed.path + ("?" + parsed.query if parsed.query else "")
+    return override.rstrip("/") + rest
+
+
+# Makes a request on the shared session with the service's timeouts, after taking a token
+# from the service's rate limiter. Pass idempotent=False
+# for GETs that start something on the other end (e.g. a transcode) so they aren't retried.
+def request(service, method, url, idempotent=True, **kwargs):
+    if service in limiters:
+        limiters[service].acquire()
+    kwargs.setdefault("timeout", timeouts.get(service, timeouts["default"]))
+    return session(retry=idempotent).request(method, rewrite_url(url), **kwargs)
+
+
+def get(service, url, **kwargs):
+    return request(service, "GET", url, **kwargs)
+
+
+def head(service, url, **kwargs):
+    kwargs.setdefault("allow_redirects", True)
+    return request(service, "HEAD", url, **kwargs)
+
+
+def post(service, url, **kwargs):
+    return request(service, "POST", url, **kwargs)
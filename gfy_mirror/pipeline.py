@@ -0,0 +1,187 @@
+import itertools
+import logging
+import queue
+import threading
+import time
+
+from utils import log, Color
+
+__author__ = 'Henri Sweers'
+
+# Tells a worker to exit
+_stop = object()
+
+# Stop markers sort after everything in a priority queue, so queued items still get done
+_stop_key = float("inf")
+
+
+# One step of the pipeline: a bounded queue and a pool of workers that run handler() on
+# each item and pass whatever it returns (unless None) to the next stage. Putting into a
+# full queue blocks, so a slow stage pushes back on the ones before it.
+#
+# With a priority function the queue hands out the most urgent item first instead of the
+# oldest. priority(item) is a head start in seconds: items are ordered by when they were
+# put minus their priority, so a hot item jumps ahead of anything queued less than that
+# long before it, and an item can never be passed by one put more than the largest
+# priority after it. Nothing starves.
+class Stage:
+    def __init__(self, name, handler, workers=1, queue_size=100, priority=None):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.priority = priority
+        self.queue = queue.PriorityQueue(maxsize=queue_size) if priority else queue.Queue(maxsize=queue_size)
+        # Tie breaker for equal keys, so items themselves never get compared
+        self.sequence = itertools.count()
+        self.next_stage = None
+        # on_drop(stage name, item), for items that fail or are filtered out before the end
+        self.on_drop = None
+        self.threads = []
+        self.lock = threading.Lock()
+        # Item each worker is handling right now, by thread name
+        self.active = {}
+        self.busy = 0
+        self.processed = 0
+        self.errors = 0
+        self.busy_time = 0.0
+        self.started = None
+
+    def start(self):
+        self.started = time.time()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name="%s-%d" % (self.name, i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, item, timeout=None):
+        self.queue.put(self._entry(item), timeout=timeout)
+
+    def stop(self):
+        for _ in self.threads:
+            self.queue.put(self._entry(_stop))
+
+    def _entry(self, item):
+        if not self.priority:
+            return item
+        key = _stop_key if item is _stop else time.time() - self.priority(item)
+        return key, next(self.sequence), item
+
+    def _item(self, entry):
+        return entry[2] if self.priority else entry
+
+    # Removes and returns everything still waiting in the queue
+    def take_queued(self):
+        items = []
+        while True:
+            try:
+                item = self._item(self.queue.get_nowait())
+            except queue.Empty:
+                return items
+            self.queue.task_done()
+            if item is not _stop:
+                items.append(item)
+
+    # Items the workers are handling right now
+    def in_flight(self):
+        with self.lock:
+            return list(self.active.values())
+
+    def _work(self):
+        while True:
+            item = self._item(self.queue.get())
+            if item is _stop:
+                self.queue.task_done()
+                return
+
+            with self.lock:
+                self.busy += 1
+                self.active[threading.current_thread().name] = item
+            start = time.time()
+            try:
+                result = self.handler(item)
+                if result is not None and self.next_stage:
+                    self.next_stage.put(result)
+                failed = False
+            except Exception:
+                log("--Error in %s stage" % self.name, Color.RED)
+                logging.exception("Error in %s stage" % self.name)
+                failed = True
+                result = None
+            finally:
+                if self.on_drop and (failed or (result is None and self.next_stage)):
+                    try:
+                        self.on_drop(self.name, item)
+                    except Exception:
+                        logging.exception("Error dropping item in %s stage" % self.name)
+                with self.lock:
+                    self.busy -= 1
+                    self.active.pop(threading.current_thread().name, None)
+                    self.busy_time += time.time() - start
+                self.queue.task_done()
+
+            with self.lock:
+                if failed:
+                    self.errors += 1
+                else:
+                    self.processed += 1
+
+    def stats(self):
+        with self.lock:
+            elapsed = max(1.0, time.time() - (self.started or time.time()))
+            done = self.processed + self.errors
+            return {
+                "stage": self.name,
+                "workers": self.workers,
+                "depth": self.queue.qsize(),
+                "busy": self.busy,
+                "processed": self.processed,
+                "errors": self.errors,
+                "per_minute": 60.0 * done / elapsed,
+                "avg_seconds": self.busy_time / done if done else 0.0
+            }
+
+
+# Stages chained in order, each feeding the next
+class Pipeline:
+    def __init__(self, stages):
+        self.stages = stages
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next_stage = next_stage
+        self.started = False
+
+    def start(self):
+        if not self.started:
+            for stage in self.stages:
+                stage.start()
+            self.started = True
+
+    # Feeds the first stage, blocking while it's full
+    def put(self, item, timeout=None):
+        self.start()
+        self.stages[0].put(item, timeout=timeout)
+
+    # Waits until everything that's been put has gone through every stage, or timeout
+    # seconds. Each stage hands its result on before marking the item done, so joining in
+    # order is enough. Returns True if it all went through.
+    def join(self, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        for stage in self.stages:
+            with stage.queue.all_tasks_done:
+                while stage.queue.unfinished_tasks:
+                    remaining = deadline - time.time() if deadline is not None else None
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    stage.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def stop(self):
+        for stage in self.stages:
+            stage.stop()
+
+    def stats(self):
+        return [stage.stats() for stage in self.stages]
+
+    def log_stats(self):
+        for s in self.stats():
+            log("--%(stage)s: %(depth)d queued, %(busy)d/%(workers)d busy, %(processed)d done, "
+                "%(errors)d errors, %(per_minute).1f/min, %(avg_seconds).2fs avg" % s, Color.CYAN)
@@ -0,0 +1,141 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+
+__author__ = 'Henri Sweers'
+
+
+# Raised on a job's future when it doesn't finish before its deadline
+class PollTimeout(TimeoutError):
+    pass
+
+
+# A single status check that gets retried until it's done or out of time
+class PollJob:
+    def __init__(self, check, deadline, initial_delay, max_delay, name):
+        self.check = check
+        self.deadline = deadline
+        self.delay = initial_delay
+        self.max_delay = max_delay
+        self.name = name
+        self.attempts = 0
+        self.future = Future()
+
+    # Exponential backoff with full jitter, capped at max_delay and the deadline
+    def next_delay(self, now):
+        self.attempts += 1
+        delay = min(self.max_delay, self.delay * (2 ** (self.attempts - 1)))
+        delay = random.uniform(delay / 2, delay)
+        return min(delay, max(0, self.deadline - now))
+
+
+# One scheduler for every in-flight transcode job. A single thread keeps the jobs in a
+# heap ordered by when they're next due, and the checks themselves run on a small pool,
+# so a waiting job costs nothing but its heap entry.
+class PollScheduler:
+    def __init__(self, workers=4):
+        self.workers = workers
+        self._jobs = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._pool = None
+        self._thread = None
+
+    # Schedules check() to run until it returns (True, result). Returns a future for the
+    # result, which fails with PollTimeout if the job is still going after `timeout` seconds.
+    def submit(self, check, timeout=60, initial_delay=1, max_delay=8, name="job"):
+        job = PollJob(check, time.time() + timeout, initial_delay, max_delay, name)
+        self._schedule(job, time.time() + initial_delay)
+        return job.future
+
+    def in_flight(self):
+        with self._cond:
+            return len(self._jobs)
+
+    def _schedule(self, job, due):
+        with self._cond:
+            if self._thread is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers)
+                self._thread = threading.Thread(target=self._run, name="poll-scheduler", daemon=True)
+                self._thread.start()
+            heapq.heappush(self._jobs, (due, next(self._counter), job))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._jobs or self._jobs[0][0] > time.time():
+                    self._cond.wait(self._jobs[0][0] - time.time() if self._jobs else None)
+                _, _, job = heapq.heappop(self._jobs)
+
+            if job.future.cancelled():
+                continue
+            if time.time() >= job.deadline:
+                settle(job.future, exception=PollTimeout("%s timed out" % job.name))
+                continue
+            self._pool.submit(self._check, job)
+
+    def _check(self, job):
+        try:
+            done, result = job.check()
+        except Exception as e:
+            settle(job.future, exception=e)
+            return
+
+        if done:
+            settle(job.future, result)
+        elif not job.future.cancelled():
+            now = time.time()
+            self._schedule(job, now + job.next_delay(now))
+
+
+# Sets a future's outcome unless it was cancelled or settled in the meantime
+def settle(future, result=None, exception=None):
+    if future.done():
+        return
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except Exception:
+        # Lost a race with cancel()
+        pass
+
+
+# Returns an already finished future, for callers that bail out before polling
+def completed_future(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+# Returns a future for the final result of a future that may itself resolve to a future,
+# e.g. a pool task that starts a transcode and hands back its polling future. Cancelling
+# it cancels whichever of them is pending, though a task that's already running can't be
+# stopped.
+def unwrap(future):
+    outer = Future()
+    outer.add_done_callback(lambda o: o.cancelled() and future.cancel())
+
+    def on_done(f):
+        if f.cancelled():
+            outer.cancel()
+        elif f.exception() is not None:
+            settle(outer, exception=f.exception())
+        elif isinstance(f.result(), Future):
+            inner = f.result()
+            outer.add_done_callback(lambda o: o.cancelled() and inner.cancel())
+            inner.add_done_callback(on_done)
+        else:
+            settle(outer, f.result())
+
+    future.add_done_callback(on_done)
+    return outer
+
+
+# Shared scheduler for all status polling
+scheduler = PollScheduler()
@@ -0,0 +1,47 @@
+import net
+from cache import MetadataUnavailable
+from metrics import timed
+from utils import metadata_cache
+
+__author__ = 'Henri Sweers'
+
+
+# Size and content type of the media at url as {"size": bytes, "type": mime type}, either
+# of which can be None if the server won't say. Cached per url.
+def probe_media(url):
+    try:
+        return metadata_cache.get("media_probe", url, lambda: fetch_media_info(url))
+    except MetadataUnavailable:
+        return {"size": None, "type": None}
+
+
+# Asks with a HEAD request, falling back to a GET for the first byte when the server
+# doesn't do HEAD or leaves out the length
+@timed("probe", "media")
+def fetch_media_info(url):
+    r = net.head("media", url)
+    r.close()
+    size = content_length(r) if r.ok else None
+    media_type = content_type(r) if r.ok else None
+    if size is None:
+        r = net.get("media", url, stream=True, headers={"Range": "bytes=0-0"})
+        r.close()
+        r.raise_for_status()
+        if r.status_code == 206:
+            # Content-Range: bytes 0-0/<total>
+            total = r.headers.get("content-range", "").rpartition("/")[2]
+            size = int(total) if total.isdigit() else None
+        else:
+            size = content_length(r)
+        media_type = media_type or content_type(r)
+    return {"size": size, "type": media_type}
+
+
+def content_length(response):
+    length = response.headers.get("content-length")
+    return int(length) if length and length.isdigit() else None
+
+
+def content_type(response):
+    value = response.headers.get("content-type")
+    return value.split(";")[0].strip().lower() if value else None
@@ -0,0 +1,60 @@
+import threading
+import time
+
+__author__ = 'Henri Sweers'
+
+
+# Token bucket: `rate` tokens a second, up to `capacity` saved up for bursts
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.time()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until a token is available, 0 if there's one now
+    def delay(self):
+        with self.lock:
+            now = time.time()
+            self._refill(now)
+            wait = 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+            return max(wait, self.blocked_until - now)
+
+    # Takes a token if there's one, without waiting
+    def try_acquire(self):
+        with self.lock:
+            now = time.time()
+            self._refill(now)
+            if now < self.blocked_until or self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    # Takes a token, waiting for one if needed
+    def acquire(self):
+        while not self.try_acquire():
+            time.sleep(max(0.01, self.delay()))
+
+    # The service told us to back off, hand out nothing for `seconds`
+    def penalize(self, seconds):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.time() + seconds)
+            self.tokens = 0
+
+
+# One bucket per service. Reddit comments are the scarce one, the rest just keep us from
+# hammering the mirror APIs when a lot of posts come in at once.
+limiters = {
+    "reddit_comment": TokenBucket(rate=1 / 10.0, capacity=3),
+    "reddit_edit": TokenBucket(rate=1 / 5.0, capacity=3),
+    "gfycat": TokenBucket(rate=5, capacity=10),
+    "offsided": TokenBucket(rate=5, capacity=10),
+    "streamable": TokenBucket(rate=5, capacity=10),
+    "imgur": TokenBucket(rate=2, capacity=5)
+}
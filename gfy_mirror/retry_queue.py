@@ -0,0 +1,91 @@
+import logging
+import random
+import threading
+import time
+
+from utils import log, Color
+
+__author__ = 'Henri Sweers'
+
+
+# Retries failed mirror uploads from the retry_jobs table in the mirror DB, on its own
+# thread so it never slows down new posts. Each job backs off exponentially (with jitter)
+# between attempts and is dropped once it's older than max_age.
+class RetryWorker:
+    def __init__(self, mirror_db, convert, on_success, base_delay=5 * 60, max_delay=2 * 60 * 60,
+                 max_age=12 * 60 * 60, interval=60, batch_size=10, leases=None):
+        self.mirror_db = mirror_db
+        # LeaseManager, so workers sharing the DB don't run the same job twice
+        self.leases = leases
+        # convert(service, title, url) -> mirror url or None, blocking
+        self.convert = convert
+        # on_success(op_id, service, url), once the mirror url is stored
+        self.on_success = on_success
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_age = max_age
+        self.interval = interval
+        self.batch_size = batch_size
+        self.stopped = threading.Event()
+        self.thread = None
+
+    # Seconds to wait before the next attempt, after `attempts` failures
+    def backoff(self, attempts):
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempts - 1)))
+        return random.uniform(delay / 2, delay)
+
+    def enqueue(self, op_id, service, source_url, title):
+        log("--Queued %s retry for %s" % (service, op_id), Color.YELLOW)
+        self.mirror_db.add_retry(op_id, service, source_url, title, time.time() + self.backoff(1))
+
+    # Runs every job that's due. Returns how many were attempted.
+    def run_once(self):
+        expired = self.mirror_db.expire_retries(time.time() - self.max_age)
+        if expired:
+            log("--Gave up on %d mirror retries" % expired, Color.RED)
+
+        jobs = self.mirror_db.due_retries(time.time(), self.batch_size)
+        for job_id, op_id, service, source_url, title, attempts in jobs:
+            if self.stopped.is_set():
+                break
+            if self.leases and not self.leases.acquire("retry:%d" % job_id):
+                continue
+            try:
+                self._retry(job_id, op_id, service, source_url, title, attempts)
+            finally:
+                if self.leases:
+                    self.leases.release("retry:%d" % job_id)
+        return len(jobs)
+
+    def _retry(self, job_id, op_id, service, source_url, title, attempts):
+        log("--Retrying %s mirror for %s (attempt %d)" % (service, op_id, attempts + 1), Color.YELLOW)
+        try:
+            url = self.convert(service, title, source_url)
+        except Exception:
+            logging.exception("Error retrying %s mirror" % service)
+            url = None
+
+        if url and url != "Error":
+            self.mirror_db.delete_retry(job_id)
+            try:
+                self.on_success(op_id, service, url)
+            except Exception:
+                logging.exception("Error storing retried %s mirror" % service)
+        else:
+            self.mirror_db.reschedule_retry(job_id, time.time() + self.backoff(attempts + 1))
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="retry-worker", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                logging.exception("Error in retry worker")
+            self.stopped.wait(self.interval)
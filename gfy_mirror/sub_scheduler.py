@@ -0,0 +1,82 @@
+import json
+import time
+
+__author__ = 'Henri Sweers'
+
+
+# Polling state for one subreddit
+class SubredditState:
+    def __init__(self, name, interval, rate=0.0, next_check=0.0, last_check=0.0):
+        self.name = name
+        self.interval = interval
+        self.rate = rate
+        self.next_check = next_check
+        self.last_check = last_check
+
+    def to_json(self):
+        return self.__dict__
+
+
+# Learns how often each subreddit gets new posts and picks a polling interval for each.
+# The rate is an exponentially weighted posts/second, the interval aims for about
+# target_posts new posts per check between min_interval and max_interval, and a check
+# that finds far more posts than the rate predicted (a goal during a match) drops the
+# subreddit straight to min_interval.
+class SubredditScheduler:
+    def __init__(self, subs, min_interval=30, max_interval=30 * 60, target_posts=1.0,
+                 smoothing=0.3, burst_factor=3.0):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_posts = target_posts
+        self.smoothing = smoothing
+        self.burst_factor = burst_factor
+        self.subs = dict((sub, SubredditState(sub, min_interval)) for sub in subs)
+
+    # Subreddits that should be checked now
+    def due(self, now=None):
+        now = now or time.time()
+        return [sub for sub, state in self.subs.items() if state.next_check <= now]
+
+    # Seconds until the next subreddit is due
+    def seconds_until_next(self, now=None):
+        now = now or time.time()
+        return max(0, min(state.next_check for state in self.subs.values()) - now)
+
+    # Updates a subreddit after a check that found new_posts posts
+    def record_check(self, sub, new_posts, now=None):
+        now = now or time.time()
+        state = self.subs[sub]
+        if state.last_check:
+            elapsed = max(1.0, now - state.last_check)
+            observed = new_posts / elapsed
+            expected = state.rate * elapsed
+            state.rate = self.smoothing * observed + (1 - self.smoothing) * state.rate
+            burst = new_posts >= 2 and new_posts > self.burst_factor * max(expected, self.target_posts)
+        else:
+            burst = False
+
+        if burst:
+            state.interval = self.min_interval
+        elif state.rate > 0:
+            state.interval = self.target_posts / state.rate
+        else:
+            # Nothing seen yet, back off gradually
+            state.interval = state.interval * 2
+        state.interval = min(self.max_interval, max(self.min_interval, state.interval))
+        state.last_check = now
+        state.next_check = now + state.interval
+
+    # Puts off a subreddit's next check without counting it as one, e.g. when another
+    # worker has it
+    def defer(self, sub, seconds, now=None):
+        now = now or time.time()
+        self.subs[sub].next_check = now + seconds
+
+    def dumps(self):
+        return json.dumps([state.to_json() for state in self.subs.values()])
+
+    # Restores state saved with dumps(), ignoring subreddits that are no longer approved
+    def loads(self, data):
+        for item in json.loads(data):
+            if item["name"] in self.subs:
+                self.subs[item["name"]] = SubredditState(**item)
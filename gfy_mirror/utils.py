@@ -1,18 +1,26 @@
-import json
 import os
 import random
 import string
 import subprocess
 import sys
-import time
-from urllib import request
-from urllib.parse import quote
 
-import requests
-from pyquery import pyquery
+from cache import MetadataCache
+from head_meta import fetch_head_meta
+from metrics import timed
 
 __author__ = 'Henri Sweers'
 
+# Shared cache for the backends' info lookups. Gfycat and imgur info doesn't change once
+# it exists, streamable fills in its files while it processes.
+metadata_cache = MetadataCache(ttls={
+    "gfycat": 24 * 60 * 60,
+    "offsided": 60 * 60,
+    "imgur": 24 * 60 * 60,
+    "streamable": 120,
+    "page_meta": 60 * 60,
+    "media_probe": 60 * 60
+})
+
 
 # Color class, used for colors in terminal
 class Color:
@@ -51,149 +59,20 @@ def log(message, *colorargs):
         print(message)
 
 
-# Convert gifs to gfycat
-def gfycat_convert(url_to_convert):
-    log('--Converting to gfycat')
-    encoded_url = quote(url_to_convert, '')
-
-    # Convert
-    key = ''.join(random.SystemRandom().choice(string.ascii_letters + string.digits) for _ in range(8))
-    transcode_url = 'http://upload.gfycat.com/transcodeRelease/' + key + '?noMd5=true&fetchUrl=' + encoded_url
-    conversion_response = requests.get(transcode_url)
-    if conversion_response.status_code == 200:
-        j = conversion_response.json()
-        if 'error' in j.keys():
-            log('----Error: ' + j['error'], Color.RED)
-            return None
-    else:
-        print(conversion_response)
-        log('----failed', Color.RED)
-        return "Error"
-
-    timeout = 60
-    while timeout > 0:
-        status_url = 'http://upload.gfycat.com/status/' + key
-        status_response = requests.get(status_url)
-        j = status_response.json()
-        if 'error' in j.keys():
-            log('----Error: ' + j['error'], Color.RED)
-            return None
-        if 'task' in j.keys() and j['task'] == 'complete':
-            log('----success', Color.GREEN)
-            gfyname = j["gfyname"]
-            return "http://gfycat.com/" + gfyname
-        timeout -= 1
-        time.sleep(1)
-
-    log("----conversion timed out", Color.RED)
-    return None
-
-
-def offsided_convert(title, url_to_convert):
-    log('--Converting to offsided')
-    req_data = {
-        'url': url_to_convert,
-        'title': title
-    }
-    r = requests.post(
-        'http://offsided.com/api/v1/upload-url',
-        data=json.dumps(req_data),
-        headers={
-            'Content-type': 'application/json',
-            'Accept': 'application/json'
-        }
-    )
-    if r.status_code != 200:
-        log('----Error uploading gif: Status code ' + str(r.status_code), Color.RED)
-        return None
-    error_text = r.json().get('error')
-    if error_text:
-        log('----Error uploading gif: ' + error_text, Color.RED)
-        return None
-    else:
-        upload_id = r.json()['id']
-        canonical_url = r.json()['canonical_url']
-
-    timeout = 60
-    while timeout > 0:
-        r = requests.get(
-            'http://offsided.com/api/v1/' + upload_id,
-            headers={
-                'Accept': 'application/json'
-            }
-        )
-        if r.json()['status'] == 'complete':
-            log('----Video is complete at ' + r.json()['canonical_url'], Color.GREEN)
-            log('----success', Color.GREEN)
-            return canonical_url
-        elif r.json()['status'] == 'error':
-            log('----Conversion failed.', Color.RED)
-            return None
-        else:
-            timeout -= 1
-            time.sleep(1)
-
-
-def get_offsided_info(f_id):
-    req_url = "http://offsided.com/link/%s" % f_id
-    r = requests.get(req_url)
-    data = r.json()
-    return data
-
-
-def streamable_convert(url_to_convert, streamable_pwd):
-    log('--Converting to streamable')
-    url = "https://api.streamable.com/import?url=%s&noresize" % url_to_convert
-    r = requests.get(url, auth=('gfy_mirror', streamable_pwd))
-    upload_id = r.json()["shortcode"]
-    return "https://streamable.com/%s" % upload_id
-
-
-def get_streamable_info(s_id):
-    req_url = "https://api.streamable.com/videos/%s" % s_id
-    r = requests.get(req_url, auth=('gfy_mirror', 'WinYeaUsEyZ7W4'))
-    data = r.json()
-    return data
-
-
-def imgur_upload(title, url_to_process):
-    log('--Uploading to imgur')
-
-    headers = {"Authorization": "Client-ID c4f5de959205bb4",
-               'Content-type': 'application/json',
-               'Accept': 'application/json'}
-
-    req_data = {
-        'image': url_to_process,
-        'title': title,
-        'type': 'URL'
-    }
-
-    r = requests.post(
-        'https://api.imgur.com/3/upload',
-        data=json.dumps(req_data),
-        headers=headers
-    )
-
-    assert r.status_code == 200
-    jdata = r.json()
-    if jdata['success']:
-        link = jdata['data']['link']
-        print('link is ' + link)
-        return link
-    else:
-        print("error")
-
-
 # Returns the .mp4 url of a vine video
+@timed("scrape", "vine")
 def retrieve_vine_video_url(vine_url):
     log('--Retrieving vine url')
-    d = pyquery.PyQuery(url=vine_url)
-    video_url = d("meta[property=twitter\\:player\\:stream]").attr['content']
+    video_url = get_page_meta(vine_url, ["twitter:player:stream"], "vine")["twitter:player:stream"]
     video_url = video_url.partition("?")[0]
     return video_url
 
 
+# Meta tags from a page's head (see head_meta.py), cached per page url
+def get_page_meta(page_url, wanted, service="default"):
+    return metadata_cache.get("page_meta", page_url, lambda: fetch_head_meta(page_url, wanted, service))
+
+
 def retrieve_vine_cdn_url(cdn_url):
     idx = cdn_url.find('.mp4')
     idx += 4
@@ -218,15 +97,3 @@ def get_id(url_to_get):
         return os.path.splitext(end)[0]
     else:
         return end
-
-
-# Get gfycat info
-def get_gfycat_info(gfy_id):
-    response = requests.get("http://www.gfycat.com/cajax/get/%s" % gfy_id)
-    jdata = response.json()
-    return jdata['gfyItem']
-
-
-def get_remote_file_size(url):
-    d = request.urlopen(url)
-    return d.length